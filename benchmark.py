@@ -0,0 +1,372 @@
+#! /usr/bin/env python
+from datetime import datetime, date, timedelta
+import argparse
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# times fetch_links.py and write_html.py on generated data and prints a json
+# report to compare commits with. every phase runs in its own process so its
+# peak rss is its own. stage times are inclusive, write_page is also counted
+# inside write_link_page and the other page writers
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+bench_start_date = date(2017, 1, 1)
+bench_words = ('the a of to and in is it that for on with as was this be are not but have you they at or from one had by '
+    'all there can about would more what so up out if some time only when which them also new like then into just any '
+    'archive reddit thread comment post link page html python server pushshift static search index user score days').split()
+max_comments_per_link = 3000
+deep_thread_chance = 0.05 # a comment starts a chain of replies to itself
+deep_thread_length = (20, 120)
+
+# stage name, items counted per call
+write_html_stages = [
+    ('generate_html', None),
+    ('load_links', lambda args, result: len(result)),
+    ('sort_comments', lambda args, result: len(args[0])),
+    ('render_markdown', None),
+    ('write_link_page', None),
+    ('write_subreddit_pages', lambda args, result: len(args[2])),
+    ('write_subreddit_search_page', None),
+    ('write_search_index', lambda args, result: len(args[1])),
+    ('write_user_pages', None),
+    ('write_index', None),
+    ('compress_pages', None),
+    ('save_manifest', None),
+    ('write_page', None),
+]
+fetch_stages = [
+    ('fetch_links', None),
+    ('write_links', lambda args, result: len(args[1])),
+    ('pushshift_get', None),
+]
+
+def get_rss_kb():
+    # linux reports kb
+    return {
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+# wraps module functions in place, calls from inside the module go through the wrapper
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def wrap(self, module, name, count_items=None):
+        func = getattr(module, name)
+        stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'items': 0})
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            stats['seconds'] += time.perf_counter() - start
+            stats['calls'] += 1
+            stats['items'] += 1 if count_items is None else count_items(args, result)
+            return result
+        setattr(module, name, timed)
+
+    def report(self):
+        report = {}
+        for name, stats in self.stages.items():
+            stats = dict(stats)
+            stats['seconds'] = round(stats['seconds'], 4)
+            stats['items_per_second'] = round(stats['items'] / stats['seconds'], 1) if stats['seconds'] > 0 else None
+            report[name] = stats
+        return report
+
+def get_author_weights(num_authors):
+    # a few authors write most posts
+    return [1.0 / (rank + 1) for rank in range(num_authors)]
+
+def get_text(rng, min_words, max_words):
+    words = [rng.choice(bench_words) for i in range(rng.randint(min_words, max_words))]
+    r = rng.random()
+    if r < 0.05:
+        return '> ' + ' '.join(words) + '\n\n**quoted** reply &gt; here'
+    if r < 0.1:
+        return ' '.join(words) + ' [a link](https://example.com/' + words[0] + ')'
+    return ' '.join(words)
+
+def get_num_comments(rng):
+    # pareto, mostly a handful of comments and now and then thousands
+    return min(int(rng.paretovariate(0.8)) - 1, max_comments_per_link)
+
+# links of one day with their comments, in the shape fetch_links.py writes
+def make_links(rng, subreddit, day, num_links, authors, author_weights, next_id):
+    links = []
+    day_ts = int((datetime(day.year, day.month, day.day) - datetime(1970, 1, 1)).total_seconds())
+    for i in range(num_links):
+        link_id = format(next_id[0], 'x')
+        next_id[0] += 1
+        created_utc = day_ts + int(i * 86400 / max(num_links, 1))
+        is_self = rng.random() < 0.4
+        comments = []
+        comment_ids = []
+        chain = 0
+        for j in range(get_num_comments(rng)):
+            comment_id = format(next_id[0], 'x')
+            next_id[0] += 1
+            if chain > 0:
+                parent_id = 't1_' + comment_ids[-1]
+                chain -= 1
+            elif len(comment_ids) == 0 or rng.random() < 0.3:
+                parent_id = 't3_' + link_id
+            else:
+                parent_id = 't1_' + rng.choice(comment_ids)
+            if rng.random() < deep_thread_chance:
+                chain = rng.randint(*deep_thread_length)
+            body = get_text(rng, 3, 60)
+            if rng.random() < 0.05:
+                body = rng.choice(['[deleted]', '[removed]'])
+            comments.append({
+                'author': rng.choices(authors, cum_weights=author_weights)[0],
+                'body': body,
+                'created_utc': created_utc + j * 7,
+                'id': comment_id,
+                'link_id': 't3_' + link_id,
+                'parent_id': parent_id,
+                'score': rng.randint(-10, 50) if rng.random() < 0.95 else rng.randint(50, 20000),
+                'stickied': False,
+                'subreddit_id': 't5_bench',
+            })
+            comment_ids.append(comment_id)
+        links.append({
+            'author': rng.choices(authors, cum_weights=author_weights)[0],
+            'created_utc': created_utc,
+            'domain': 'self.' + subreddit if is_self else 'example.com',
+            'id': link_id,
+            'is_self': is_self,
+            'num_comments': len(comments),
+            'over_18': False,
+            'permalink': '/r/' + subreddit + '/comments/' + link_id + '/post_' + link_id + '/',
+            'retrieved_on': created_utc + 86400,
+            'score': rng.randint(0, 100) if rng.random() < 0.9 else rng.randint(100, 50000),
+            'selftext': get_text(rng, 10, 300) if is_self else '',
+            'stickied': False,
+            'subreddit_id': 't5_bench',
+            'title': get_text(rng, 3, 15).split('\n')[0],
+            'url': 'https://example.com/' + link_id,
+            'comments': comments,
+        })
+    return links
+
+def iter_days(params):
+    for sub_num in range(params['subs']):
+        subreddit = 'bench%s' % sub_num
+        for day_num in range(params['days']):
+            yield subreddit, bench_start_date + timedelta(days=day_num)
+
+def get_generator(params, seed_offset=0):
+    rng = random.Random(params['seed'] + seed_offset)
+    authors = ['author%s' % i for i in range(params['authors'])] + ['[deleted]']
+    author_weights = list(itertools.accumulate(get_author_weights(len(authors))))
+    return rng, authors, author_weights
+
+# phases, each run in a child process in its own work directory
+
+def run_generate(params):
+    import fetch_links
+    timer = StageTimer()
+    timer.wrap(fetch_links, 'write_links', lambda args, result: len(args[1]))
+    rng, authors, author_weights = get_generator(params)
+    next_id = [100000]
+    stats = {'links': 0, 'comments': 0}
+    for subreddit, day in iter_days(params):
+        num_links = max(1, int(rng.gauss(params['links_per_day'], params['links_per_day'] / 4)))
+        links = make_links(rng, subreddit, day, num_links, authors, author_weights, next_id)
+        stats['links'] += len(links)
+        stats['comments'] += sum(len(l['comments']) for l in links)
+        fetch_links.write_links(subreddit, links)
+    return {'stages': timer.report(), 'data': stats}
+
+def run_write_html(params):
+    if not os.path.exists('templates'):
+        os.symlink(os.path.join(repo_dir, 'templates'), 'templates')
+    import write_html
+    argv = ['--noimages', '--jobs', str(params['jobs'])] + params['write_html_args']
+    write_html.args = write_html.parse_args(argv)
+    timer = StageTimer()
+    for name, count_items in write_html_stages:
+        timer.wrap(write_html, name, count_items)
+    write_html.generate_html(write_html.args.min_score, write_html.args.min_comments, write_html.args.hide_deleted_comments, write_html.args.jobs)
+    return {'stages': timer.report(), 'args': argv, 'report': write_html.get_report()}
+
+# enough of the pushshift api for fetch_links.py, served from generated links
+class FakePushshiftHandler(BaseHTTPRequestHandler):
+    links = []
+    comments = {}
+    requests = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        with self.lock:
+            FakePushshiftHandler.requests += 1
+        after = int(query.get('after', 0))
+        before = int(query.get('before', 2 ** 40))
+        limit = int(query.get('limit', 100))
+        if url.path == '/reddit/submission/search':
+            results = [dict((k, v) for k, v in l.items() if k != 'comments') for l in self.links if after < l['created_utc'] < before]
+            self.send_json(results[:limit])
+        elif url.path.startswith('/reddit/submission/comment_ids/'):
+            link_id = url.path.rsplit('/', 1)[1]
+            self.send_json([c['id'] for l in self.links if l['id'] == link_id for c in l['comments']])
+        elif url.path == '/reddit/comment/search':
+            results = [self.comments[i] for i in query.get('ids', '').split(',') if i in self.comments]
+            results = [c for c in results if after < c['created_utc'] < before]
+            results.sort(key=lambda c: c['created_utc'], reverse=query.get('sort', 'desc') == 'desc')
+            self.send_json(results[:limit])
+        else:
+            self.send_error(404)
+
+def run_fetch(params):
+    import fetch_links
+    rng, authors, author_weights = get_generator(params, 1)
+    next_id = [100000]
+    links = []
+    for day_num in range(params['fetch_days']):
+        day = bench_start_date + timedelta(days=day_num)
+        links += make_links(rng, 'benchfetch', day, params['links_per_day'], authors, author_weights, next_id)
+    FakePushshiftHandler.links = links
+    FakePushshiftHandler.comments = dict((c['id'], c) for l in links for c in l['comments'])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakePushshiftHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    fetch_links.pushshift_url = 'http://127.0.0.1:%s' % server.server_address[1]
+    fetch_links.pushshift_rate_limit_per_minute = 6000000
+    timer = StageTimer()
+    for name, count_items in fetch_stages:
+        timer.wrap(fetch_links, name, count_items)
+    # fetch_links takes local time dates, like its command line
+    date_start = time.localtime(time.mktime(bench_start_date.timetuple()))
+    date_stop = time.localtime(time.mktime((bench_start_date + timedelta(days=params['fetch_days'] - 1)).timetuple()))
+    fetch_links.fetch_links('benchfetch', date_start, date_stop)
+    server.shutdown()
+    return {
+        'stages': timer.report(),
+        'data': {'links': len(links), 'comments': len(FakePushshiftHandler.comments), 'requests': FakePushshiftHandler.requests},
+    }
+
+phases = {
+    'generate': run_generate,
+    'write_html': run_write_html,
+    'write_html_rerun': run_write_html,
+    'fetch': run_fetch,
+}
+
+def run_phase_process(phase, params, work_dir, conn):
+    os.chdir(work_dir)
+    sys.path.insert(0, repo_dir)
+    # quiet, the pipeline prints a line per link
+    devnull = open(os.devnull, 'w')
+    sys.stdout = devnull
+    start = time.perf_counter()
+    try:
+        report = phases[phase](params)
+    except Exception as e:
+        conn.send({'error': '%s: %s' % (type(e).__name__, e)})
+        raise
+    report['seconds'] = round(time.perf_counter() - start, 4)
+    report.update(get_rss_kb())
+    conn.send(report)
+
+def run_phase(phase, params, work_dir):
+    parent_conn, child_conn = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=run_phase_process, args=(phase, params, work_dir, child_conn))
+    process.start()
+    try:
+        report = parent_conn.recv()
+    except EOFError:
+        report = {'error': 'exited with %s' % process.exitcode}
+    process.join()
+    print('%s: %ss' % (phase, report.get('seconds', '-')), file=sys.stderr)
+    return report
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(params, phase_names):
+    work_dir = params['work_dir'] or tempfile.mkdtemp(prefix='archive-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    report = {
+        'commit': get_commit(),
+        'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': dict((k, v) for k, v in params.items() if k != 'work_dir'),
+        'phases': {},
+    }
+    for phase in phase_names:
+        # fetch writes to its own directory so it doesn't append to the generated data
+        phase_dir = os.path.join(work_dir, 'fetch') if phase == 'fetch' else work_dir
+        os.makedirs(phase_dir, exist_ok=True)
+        report['phases'][phase] = run_phase(phase, params, phase_dir)
+        if 'error' in report['phases'][phase]:
+            break
+    if not params['work_dir'] and not params['keep']:
+        shutil.rmtree(work_dir)
+    return report
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--subs', default=2, type=int, help='subreddits to generate, default 2')
+    parser.add_argument('--days', default=30, type=int, help='days of links per subreddit, default 30')
+    parser.add_argument('--links-per-day', default=40, type=int, help='average links per day, default 40')
+    parser.add_argument('--authors', default=5000, type=int, help='distinct authors, default 5000')
+    parser.add_argument('--fetch-days', default=3, type=int, help='days of links served by the fake api to fetch_links.py, default 3')
+    parser.add_argument('--seed', default=1, type=int, help='random seed, the same seed generates the same data, default 1')
+    parser.add_argument('--jobs', default=1, type=int, help='write_html.py --jobs, stages run in workers are not timed, default 1')
+    parser.add_argument('--write-html-args', default='', help='more write_html.py arguments, e.g. "--minify --compress"')
+    parser.add_argument('--phases', default=','.join(phases.keys()), help='comma separated phases to run, default %(default)s')
+    parser.add_argument('--work-dir', default=None, help='keep generated data and output here instead of a temporary directory')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--output', default=None, help='write the json report to this file instead of stdout')
+    args=parser.parse_args()
+
+    params = {
+        'subs': args.subs,
+        'days': args.days,
+        'links_per_day': args.links_per_day,
+        'authors': args.authors,
+        'fetch_days': args.fetch_days,
+        'seed': args.seed,
+        'jobs': args.jobs,
+        'write_html_args': args.write_html_args.split(),
+        'work_dir': args.work_dir,
+        'keep': args.keep,
+    }
+    report = run_benchmark(params, [p for p in args.phases.split(',') if p in phases])
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
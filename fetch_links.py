@@ -7,11 +7,31 @@ from pprint import pprint
 import json
 import csv
 import os
+import hashlib
+import sqlite3
+from urllib.parse import urlencode
+from collections import OrderedDict, deque
+from itertools import chain
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
 from psaw import PushshiftAPI
+import sqlite_storage
 
+pushshift_url = 'https://api.pushshift.io'
 pushshift_rate_limit_per_minute = 20
+pushshift_timeout = (10, 60) # connect, read seconds
+pushshift_max_retries = 10
+pushshift_backoff = 2 # seconds, doubled on every retry
+pushshift_max_backoff = 300
 max_comments_per_query = 150
+comment_fetch_workers = 4 # concurrent comment requests
+comment_batch_window = 200 # submissions waiting for their comments
 write_every = 10
+checkpoint_filename = 'checkpoint.json' # per subreddit, removed when a run completes
+pushshift_cache_file = 'cache/pushshift.sqlite'
+pushshift_cache_mode = None # 'record', 'replay' or 'ttl'
+pushshift_cache_ttl = 7 * 86400
 
 link_fields = ['author', 'created_utc', 'domain', 'id', 'is_self', 
     'num_comments', 'over_18', 'permalink', 'retrieved_on', 'score', 
@@ -19,12 +39,247 @@ link_fields = ['author', 'created_utc', 'domain', 'id', 'is_self',
 comment_fields = ['author', 'body', 'created_utc', 'id', 'link_id', 
     'parent_id', 'score', 'stickied', 'subreddit_id']
 
-def fetch_links(subreddit=None, date_start=None, date_stop=None, limit=None, score=None, self_only=False):
+# token bucket shared by every pushshift request of the run. 429 and 5xx
+# responses pause all requests and halve the rate, which recovers on success
+class RateLimiter:
+    def __init__(self, rate_per_minute, burst=1):
+        self.max_rate = rate_per_minute / 60.0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def back_off(self, seconds):
+        with self.lock:
+            self.rate = max(self.rate / 2, self.max_rate / 16)
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+rate_limiter = None
+
+# one keep-alive session per thread
+http_sessions = threading.local()
+def get_http_session():
+    if not hasattr(http_sessions, 'session'):
+        http_sessions.session = requests.Session()
+    return http_sessions.session
+
+# responses are cached with cache modes, record: always request and store,
+# replay: only answer from the cache, ttl: request what is missing or older
+# than pushshift_cache_ttl. comment searches by id are cached per comment as
+# their batches are not the same from run to run
+def pushshift_get(url, params={}):
+    if pushshift_cache_mode is not None:
+        data = get_cached_response(url, params)
+        if data is not None:
+            return data
+        if pushshift_cache_mode == 'replay':
+            raise Exception('no cached pushshift response for %s %s' % (url, get_query_string(params)))
+    data = request_pushshift(url, params)
+    if pushshift_cache_mode is not None:
+        cache_response(url, params, data)
+    return data
+
+def request_pushshift(url, params={}):
+    for attempt in range(pushshift_max_retries):
+        rate_limiter.acquire()
+        delay = min(pushshift_max_backoff, pushshift_backoff * 2 ** attempt)
+        try:
+            r = get_http_session().get(url, params=params, timeout=pushshift_timeout)
+        except requests.exceptions.RequestException as e:
+            print('pushshift request failed, retrying in %ss: %s' % (delay, e))
+            rate_limiter.back_off(delay)
+            continue
+        if r.status_code == 200:
+            rate_limiter.recover()
+            return r.json()
+        if r.status_code != 429 and r.status_code < 500:
+            raise Exception('pushshift returned %s for %s' % (r.status_code, r.url))
+        if r.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, int(r.headers['Retry-After']))
+        print('pushshift returned %s, retrying in %ss' % (r.status_code, delay))
+        rate_limiter.back_off(delay)
+    raise Exception('Unable to connect to pushshift. Max retries exceeded for %s' % url)
+
+response_cache = {}
+def get_response_cache():
+    if 'db' not in response_cache:
+        os.makedirs(os.path.dirname(pushshift_cache_file), exist_ok=True)
+        db = sqlite3.connect(pushshift_cache_file, check_same_thread=False)
+        db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, query TEXT, body TEXT, fetched INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS comments (id TEXT PRIMARY KEY, body TEXT, fetched INTEGER)')
+        db.commit()
+        response_cache['db'] = db
+        response_cache['lock'] = threading.Lock()
+    return response_cache['db']
+
+# the same query always gives the same string, list params are joined like pushshift expects them
+def get_query_string(params):
+    query = []
+    for key in sorted(params):
+        value = params[key]
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        query.append((key, str(value)))
+    return urlencode(query)
+
+def is_comment_id_search(url, params):
+    return url.endswith('/reddit/comment/search') and 'ids' in params
+
+def get_cached_response(url, params):
+    if pushshift_cache_mode == 'record':
+        return None
+    min_fetched = 0
+    if pushshift_cache_mode == 'ttl':
+        min_fetched = int(time.time()) - pushshift_cache_ttl
+    db = get_response_cache()
+    with response_cache['lock']:
+        if is_comment_id_search(url, params):
+            # comments that were requested but not returned are stored without body
+            comments = []
+            for comment_id in params['ids'].split(','):
+                row = db.execute('SELECT body FROM comments WHERE id = ? AND fetched >= ?', (comment_id, min_fetched)).fetchone()
+                if row is None:
+                    return None
+                if row[0] is not None:
+                    comments.append(json.loads(row[0]))
+            comments.sort(key=lambda c: int(c['created_utc']), reverse=True)
+            return {'data': comments}
+        query = url + '?' + get_query_string(params)
+        row = db.execute('SELECT body FROM responses WHERE key = ? AND fetched >= ?', (hashlib.sha1(query.encode('utf-8')).hexdigest(), min_fetched)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+def cache_response(url, params, data):
+    db = get_response_cache()
+    now = int(time.time())
+    with response_cache['lock'], db:
+        if is_comment_id_search(url, params):
+            bodies = dict((comment_id, None) for comment_id in params['ids'].split(','))
+            for c in data['data']:
+                bodies[c['id']] = json.dumps(c)
+            db.executemany('INSERT OR REPLACE INTO comments (id, body, fetched) VALUES (?, ?, ?)', [(comment_id, body, now) for comment_id, body in bodies.items()])
+            return
+        query = url + '?' + get_query_string(params)
+        db.execute('INSERT OR REPLACE INTO responses (key, query, body, fetched) VALUES (?, ?, ?, ?)', (hashlib.sha1(query.encode('utf-8')).hexdigest(), query, json.dumps(data), now))
+
+# psaw pages through submissions, its requests go through pushshift_get()
+class PushshiftClient(PushshiftAPI):
+    @property
+    def base_url(self):
+        return pushshift_url + '/{endpoint}'
+
+    def _get(self, url, payload={}):
+        return pushshift_get(url, payload)
+
+def fetch_comment_ids(link):
+    return pushshift_get(pushshift_url + '/reddit/submission/comment_ids/' + link['id'])['data']
+
+def fetch_comments(comment_ids):
+    comment_params = {
+        'filter': ','.join(comment_fields),
+        'ids': ','.join(comment_ids),
+        'limit': max_comments_per_query,
+        'sort': 'desc',
+    }
+    return pushshift_get(pushshift_url + '/reddit/comment/search', comment_params)['data']
+
+# packs the comment ids of many submissions into full max_comments_per_query
+# requests and routes the returned comments back to their submission. only the
+# http requests run in the executor, the bookkeeping happens in update()
+class CommentBatcher:
+    def __init__(self, executor):
+        self.executor = executor
+        self.lookups = [] # fetches waiting for their comment id list
+        self.queue = [] # (fetch, comment id) not requested yet
+        self.requests = [] # (future, [(fetch, comment id), ...]) in flight
+
+    def add(self, link, with_comments=True):
+        link['comments'] = []
+        fetch = {'link': link, 'comment_ids': [], 'unresolved': 0, 'lookup': None}
+        if with_comments:
+            fetch['lookup'] = self.executor.submit(fetch_comment_ids, link)
+            self.lookups.append(fetch)
+        return fetch
+
+    # a partial batch is only requested with flush, when nothing else can fill it
+    def update(self, flush=False):
+        for fetch in [f for f in self.lookups if f['lookup'].done()]:
+            self.lookups.remove(fetch)
+            fetch['comment_ids'] = fetch['lookup'].result()
+            # print('%s comment_ids: %s' % (fetch['link']['id'], fetch['comment_ids']))
+            fetch['unresolved'] = len(fetch['comment_ids'])
+            fetch['lookup'] = None
+            self.queue += [(fetch, comment_id) for comment_id in fetch['comment_ids']]
+            self.log_done(fetch)
+
+        while len(self.queue) >= max_comments_per_query or (flush and len(self.queue) > 0):
+            batch = self.queue[:max_comments_per_query]
+            self.queue = self.queue[max_comments_per_query:]
+            future = self.executor.submit(fetch_comments, [comment_id for fetch, comment_id in batch])
+            self.requests.append((future, batch))
+
+        for request in [r for r in self.requests if r[0].done()]:
+            self.requests.remove(request)
+            future, batch = request
+            owners = {}
+            for fetch, comment_id in batch:
+                owners[comment_id] = fetch
+                fetch['unresolved'] -= 1
+            for c in future.result():
+                if c['id'] in owners:
+                    owners[c['id']]['link']['comments'].append(c)
+            for fetch in dict((id(f), f) for f, comment_id in batch).values():
+                self.log_done(fetch)
+
+    def is_done(self, fetch):
+        return fetch['lookup'] is None and fetch['unresolved'] == 0
+
+    def log_done(self, fetch):
+        if self.is_done(fetch) and len(fetch['comment_ids']) > 0:
+            link = fetch['link']
+            print('%s fetch link %s comments %s/%s' % (datetime.utcfromtimestamp(int(link['created_utc'])), link['id'], len(link['comments']), len(fetch['comment_ids'])))
+
+    def wait(self):
+        futures = [f['lookup'] for f in self.lookups] + [r[0] for r in self.requests]
+        if len(futures) > 0:
+            wait(futures, return_when=FIRST_COMPLETED)
+
+def fetch_links(subreddit=None, date_start=None, date_stop=None, limit=None, score=None, self_only=False, sqlite=False, id_index=False):
     if subreddit is None or date_start is None or date_stop is None:
         print('ERROR: missing required arguments')
         exit()
 
-    api = PushshiftAPI(rate_limit_per_minute=pushshift_rate_limit_per_minute, detect_local_tz=False)
+    # keep writing to a subreddit's sqlite file once it has one
+    if sqlite_storage.db_exists(subreddit):
+        sqlite = True
+
+    global rate_limiter
+    rate_limiter = RateLimiter(pushshift_rate_limit_per_minute)
+    api = PushshiftClient(rate_limit_per_minute=pushshift_rate_limit_per_minute, detect_local_tz=False)
 
     # get links
     links = []
@@ -43,58 +298,193 @@ def fetch_links(subreddit=None, date_start=None, date_stop=None, limit=None, sco
         params['score'] = score
     if self_only:
         params['is_self'] = True
-    link_results = list(api.search_submissions(**params))
-    print('processing %s links' % len(link_results))
-    for s in link_results:
-        # print('%s %s' % (datetime.utcfromtimestamp(int(s.d_['created_utc'])), s.d_['title']))
-        # pprint(s)
-
-        # get comment ids
-        comments = []
-        if s.d_['num_comments'] > 0 and not comment_data_exists(subreddit, s.d_['created_utc'], s.d_['id']):
-            comment_ids = list(api._get_submission_comment_ids(s.d_['id']))
-            # print('%s comment_ids: %s' % (data['id'], comment_ids))
-
-            # get comments
-            if (len(comment_ids) > 0):
-                mychunks = []
-                if len(comment_ids) > max_comments_per_query:
-                    mychunks = chunks(comment_ids, max_comments_per_query)
-                else:
-                    mychunks = [comment_ids]
-                for chunk in mychunks:
-                    comment_params = {
-                        'filter': comment_fields,
-                        'ids': ','.join(chunk),
-                        'limit': max_comments_per_query,
-                    }
-                    comments_results = list(api.search_comments(**comment_params))
-                    print('%s fetch link %s comments %s/%s' % (datetime.utcfromtimestamp(int(s.d_['created_utc'])), s.d_['id'], len(comments_results), len(comment_ids)))
-                    for c in comments_results:
-                        comments.append(c.d_)
-
-        s.d_['comments'] = comments
-        links.append(s.d_)
-
-        # write results
-        if len(links) >= write_every:
-            success = write_links(subreddit, links)
-            if success:
-                links = []
+
+    # continue an interrupted run of the same range after its last written link
+    checkpoint_key = [params['after'], params['before'], limit, score, self_only]
+    pending = []
+    checkpoint = load_checkpoint(subreddit)
+    if checkpoint is not None and checkpoint['key'] == checkpoint_key:
+        params['after'] = checkpoint['after']
+        pending = checkpoint['pending']
+        print('resuming after %s with %s pending links' % (datetime.utcfromtimestamp(int(checkpoint['after'])), len(pending)))
+
+    # submission pages are requested as the loop below consumes them, so
+    # comments are fetched and written while later pages are still coming in
+    pending_ids = set(l['id'] for l in pending)
+    link_results = chain(pending, (s.d_ for s in api.search_submissions(**params) if s.d_['id'] not in pending_ids))
+    processed = 0
+
+    # comments of many submissions are requested together, results are written in submission order
+    window = deque()
+    with ThreadPoolExecutor(max_workers=comment_fetch_workers) as executor:
+        batcher = CommentBatcher(executor)
+        link_results = iter(link_results)
+        exhausted = False
+        while not exhausted or len(window) > 0:
+            if not exhausted and len(window) <= comment_batch_window:
+                link = next(link_results, None)
+                if link is None:
+                    exhausted = True
+                    continue
+                # print('%s %s' % (datetime.utcfromtimestamp(int(link['created_utc'])), link['title']))
+                # pprint(link)
+                with_comments = link['num_comments'] > 0 and not comment_data_exists(subreddit, link['created_utc'], link['id'], sqlite)
+                window.append(batcher.add(link, with_comments))
+                processed += 1
+
+            full = exhausted or len(window) > comment_batch_window
+            batcher.update(full)
+            while len(window) > 0 and batcher.is_done(window[0]):
+                links.append(window.popleft()['link'])
+
+                # write results
+                if len(links) >= write_every:
+                    success = write_fetched_links(subreddit, links, window, checkpoint_key, sqlite, id_index)
+                    if success:
+                        links = []
+
+            # keep paging submissions until the window is full
+            if full and len(window) > 0:
+                batcher.wait()
 
     # write remining results
     if len(links):
-        write_links(subreddit, links)
+        success = write_fetched_links(subreddit, links, window, checkpoint_key, sqlite, id_index)
+        if success:
+            links = []
+
+    print('processed %s links' % processed)
+    if len(links) == 0:
+        remove_checkpoint(subreddit)
+
+# the checkpoint is only advanced past links that were written. links whose
+# comments are still being fetched are kept in it and fetched first on resume
+def write_fetched_links(subreddit, links, window, checkpoint_key, sqlite=False, id_index=False):
+    success = write_links(subreddit, links, sqlite, id_index)
+    if success:
+        pending = [fetch['link'] for fetch in window]
+        save_checkpoint(subreddit, checkpoint_key, links[-1]['created_utc'], pending)
+    return success
+
+def get_checkpoint_path(subreddit):
+    return 'data/' + subreddit + '/' + checkpoint_filename
+
+def load_checkpoint(subreddit):
+    try:
+        with open(get_checkpoint_path(subreddit), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return None
+
+def save_checkpoint(subreddit, key, after, pending):
+    path = get_checkpoint_path(subreddit)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump({'key': key, 'after': after, 'pending': pending}, file)
+    os.replace(path + '.tmp', path)
+
+def remove_checkpoint(subreddit):
+    if os.path.isfile(get_checkpoint_path(subreddit)):
+        os.remove(get_checkpoint_path(subreddit))
+
+# ids already written per day directory, kept across write_links() calls so
+# each csv is parsed at most once. with id_index the ids are also appended to a
+# sidecar file in the day directory, which later runs read instead of the csvs.
+id_index_filename = 'ids.idx'
+id_cache_days = 30
+id_cache = OrderedDict()
+
+def get_day_ids(path, id_index=False):
+    if path in id_cache:
+        id_cache.move_to_end(path)
+        return id_cache[path]
+
+    day_ids = {'links': None, 'comments': {}, 'index_lines': [], 'index_valid': False}
+    if id_index:
+        if id_index_is_fresh(path):
+            day_ids['links'] = set()
+            with open(path + '/' + id_index_filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) == 1:
+                        day_ids['links'].add(parts[0])
+                    elif len(parts) == 2:
+                        if parts[0] not in day_ids['comments']:
+                            day_ids['comments'][parts[0]] = set()
+                        day_ids['comments'][parts[0]].add(parts[1])
+        else:
+            # rebuild the sidecar from every csv of the day
+            get_link_ids(day_ids, path + '/links.csv')
+            for filename in os.listdir(path):
+                if filename.endswith('.csv') and filename != 'links.csv':
+                    get_comment_ids(day_ids, filename[:-4], path + '/' + filename)
+            with open(path + '/' + id_index_filename, 'w', encoding='utf-8') as file:
+                for link_id in day_ids['links']:
+                    file.write(link_id + '\n')
+                for link_id, comment_ids in day_ids['comments'].items():
+                    for comment_id in comment_ids:
+                        file.write(link_id + ' ' + comment_id + '\n')
+        day_ids['index_valid'] = True
+
+    id_cache[path] = day_ids
+    while len(id_cache) > id_cache_days:
+        id_cache.popitem(last=False)
+    return day_ids
+
+# the sidecar is only trusted if no csv was changed or removed after it was written
+def id_index_is_fresh(path):
+    index_path = path + '/' + id_index_filename
+    if not os.path.isfile(index_path) or not os.path.isfile(path + '/links.csv'):
+        return False
+    index_mtime = os.stat(index_path).st_mtime_ns
+    if index_mtime < os.stat(path).st_mtime_ns:
+        return False
+    # a csv rewritten in place leaves the directory mtime as it was
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.csv') and entry.stat().st_mtime_ns > index_mtime:
+                return False
+    return True
+
+def get_link_ids(day_ids, filepath):
+    if day_ids['links'] is None:
+        day_ids['links'] = set()
+        if os.path.isfile(filepath):
+            with open(filepath, 'r', encoding='utf-8') as file:
+                reader = csv.DictReader(file)
+                for row in reader:
+                    day_ids['links'].add(row['id'])
+    return day_ids['links']
+
+def get_comment_ids(day_ids, link_id, filepath):
+    if link_id not in day_ids['comments']:
+        day_ids['comments'][link_id] = set()
+        if os.path.isfile(filepath):
+            with open(filepath, 'r', encoding='utf-8') as file:
+                reader = csv.DictReader(file)
+                for row in reader:
+                    day_ids['comments'][link_id].add(row['id'])
+    return day_ids['comments'][link_id]
+
+def write_id_index(path, day_ids):
+    if day_ids['index_valid'] and len(day_ids['index_lines']) > 0:
+        with open(path + '/' + id_index_filename, 'a', encoding='utf-8') as file:
+            file.write(''.join(day_ids['index_lines']))
+    day_ids['index_lines'] = []
 
 # csvs are not guaranteed to be sorted by date but you can resume broken runs
 # and change sort criteria later to add more posts without getting duplicates.
 # delete csvs and re-run to update existing posts
-def write_links(subreddit, links):
+def write_links(subreddit, links, sqlite=False, id_index=False):
+    if sqlite and links and len(links) > 0:
+        wrote_links, wrote_comments = sqlite_storage.write_links(subreddit, links)
+        print('got %s links, wrote %s and %s comments' % (len(links), wrote_links, wrote_comments))
+        return True
     if links and len(links) > 0:
         writing_day = None
         file = None
         writer = None
-        existing_link_ids = []
+        day_ids = None
         wrote_links = 0
         wrote_comments = 0
 
@@ -102,7 +492,6 @@ def write_links(subreddit, links):
             # print('%s link %s' % (r['id'], r['title']))
 
             # grab link comments
-            existing_comment_ids = []
             comments = r['comments']
             # print('%s comments %s' % (r['id'], comments))
 
@@ -112,44 +501,41 @@ def write_links(subreddit, links):
             if created != writing_day:
                 if file:
                     file.close()
+                    write_id_index(path, day_ids)
                 writing_day = created
                 path = 'data/' + subreddit + '/' + created_path
                 os.makedirs(path, exist_ok=True)
+                day_ids = get_day_ids(path, id_index)
 
-                # create and parse existing links
+                # create or append to links, existing ids come from the day's id cache
                 filename = 'links.csv'
                 filepath = path + '/' + filename
                 if not os.path.isfile(filepath):
+                    day_ids['links'] = set()
                     file = open(filepath, 'a', encoding='utf-8')
                     writer = csv.DictWriter(file, fieldnames=link_fields)
                     writer.writeheader()
                     # print('created %s' % filepath)
                 else:
-                    with open(filepath, 'r', encoding='utf-8') as file:
-                        reader = csv.DictReader(file)
-                        for row in reader:
-                            existing_link_ids.append(row['id'])
-
+                    get_link_ids(day_ids, filepath)
                     file = open(filepath, 'a', encoding='utf-8')
                     writer = csv.DictWriter(file, fieldnames=link_fields)
+            existing_link_ids = day_ids['links']
 
-            # create and parse existing comments
+            # create or append to comments
             # writing empty comments csvs resuming and comment_data_exists()
             filename = r['id'] + '.csv'
             filepath = path + '/' + filename
             if not os.path.isfile(filepath):
+                day_ids['comments'][r['id']] = set()
                 comments_file = open(filepath, 'a', encoding='utf-8')
                 comments_writer = csv.DictWriter(comments_file, fieldnames=comment_fields)
                 comments_writer.writeheader()
                 # print('created %s' % filepath)
             else:
-                with open(filepath, 'r', encoding='utf-8') as comments_file:
-                    reader = csv.DictReader(comments_file)
-                    for row in reader:
-                        existing_comment_ids.append(row['id'])
-
                 comments_file = open(filepath, 'a', encoding='utf-8')
                 comments_writer = csv.DictWriter(comments_file, fieldnames=comment_fields)
+            existing_comment_ids = get_comment_ids(day_ids, r['id'], filepath)
 
             # write link row
             if r['id'] not in existing_link_ids:
@@ -158,6 +544,8 @@ def write_links(subreddit, links):
                         del r[field]
 
                 writer.writerow(r)
+                existing_link_ids.add(r['id'])
+                day_ids['index_lines'].append(r['id'] + '\n')
                 wrote_links += 1
 
             # write comments
@@ -167,9 +555,14 @@ def write_links(subreddit, links):
                         if field not in comment_fields:
                             del c[field]
                     comments_writer.writerow(c)
+                    existing_comment_ids.add(c['id'])
+                    day_ids['index_lines'].append(r['id'] + ' ' + c['id'] + '\n')
                     wrote_comments += 1
             comments_file.close()
 
+        if file:
+            file.close()
+            write_id_index(path, day_ids)
 
         print('got %s links, wrote %s and %s comments' % (len(links), wrote_links, wrote_comments))
     return True
@@ -181,7 +574,10 @@ def link_data_exists(subreddit, date):
         return False
     return True
 
-def comment_data_exists(subreddit, link_created_utc, link_id):
+def comment_data_exists(subreddit, link_created_utc, link_id, sqlite=False):
+    # links are stored together with their comments
+    if sqlite:
+        return sqlite_storage.link_exists(subreddit, link_id)
     created_ts = int(link_created_utc)
     created_path = datetime.utcfromtimestamp(created_ts).strftime('%Y/%m/%d')
     path = 'data/' + subreddit + '/' + created_path + '/' + link_id + '.csv'
@@ -208,6 +604,10 @@ if __name__ == '__main__':
     parser.add_argument('--limit', default=None, help='pushshift api limit param, default None')
     parser.add_argument('--score', default=None, help='pushshift api score param, e.g. "> 10", default None')
     parser.add_argument('--self_only', action="store_true", help='only fetch selftext submissions, default False')
+    parser.add_argument('--id-index', action="store_true", help='keep written ids in an ' + id_index_filename + ' file per day for faster resumes, default False')
+    parser.add_argument('--cache', choices=['record', 'replay', 'ttl'], default=None, help='cache pushshift responses in ' + pushshift_cache_file + ', replay answers only from the cache, default None')
+    parser.add_argument('--cache-ttl', type=float, default=pushshift_cache_ttl / 86400, help='days cached responses are used in ttl mode, default %(default)s')
+    parser.add_argument('--sqlite', action="store_true", help='store data in data/<subreddit>/' + sqlite_storage.db_filename + ' instead of csv files, default False')
     args=parser.parse_args()
 
     self_only = False
@@ -215,5 +615,7 @@ if __name__ == '__main__':
         self_only = True
 
     args.subreddit = args.subreddit.lower()
+    pushshift_cache_mode = args.cache
+    pushshift_cache_ttl = int(args.cache_ttl * 86400)
 
-    fetch_links(args.subreddit, args.date_start, args.date_stop, args.limit, args.score, self_only)
+    fetch_links(args.subreddit, args.date_start, args.date_stop, args.limit, args.score, self_only, args.sqlite, args.id_index)
@@ -0,0 +1,116 @@
+import numpy as np
+
+# links of a subreddit or user held in columns instead of one dict per link.
+# every field is kept as its original string in one joined buffer with
+# offsets, the fields pages sort and filter on are also parsed once into
+# int64 columns so sorting, filtering and paging are array operations
+int_fields = ['score', 'num_comments', 'created_utc']
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+class LinkTable:
+    def __init__(self, fields, buffers, offsets, ints, missing):
+        self.fields = fields
+        self.buffers = buffers # field -> str of all values joined
+        self.offsets = offsets # field -> int64 array, value i is buffer[offsets[i]:offsets[i + 1]]
+        self.ints = ints # field -> int64 array, 0 where missing
+        self.missing = missing # field -> bool array, empty or absent values
+
+    @classmethod
+    def from_links(cls, links, fields=None):
+        if fields is None:
+            fields = [f for f in (links[0].keys() if len(links) > 0 else []) if f != 'comments']
+        buffers = {}
+        offsets = {}
+        for f in fields:
+            values = [link.get(f) for link in links]
+            values = ['' if v is None else str(v) for v in values]
+            buffers[f] = ''.join(values)
+            offsets[f] = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(v) for v in values], out=offsets[f][1:])
+        ints = {}
+        missing = {}
+        for f in int_fields:
+            if f not in buffers:
+                continue
+            lengths = np.diff(offsets[f])
+            missing[f] = lengths == 0
+            ints[f] = np.zeros(len(links), dtype=np.int64)
+            for i in np.flatnonzero(~missing[f]):
+                ints[f][i] = parse_int(buffers[f][offsets[f][i]:offsets[f][i + 1]])
+        return cls(fields, buffers, offsets, ints, missing)
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [t for t in tables if len(t) > 0]
+        if len(tables) == 0:
+            return cls.from_links([])
+        fields = tables[0].fields
+        buffers = {}
+        offsets = {}
+        for f in fields:
+            buffers[f] = ''.join(t.buffers[f] for t in tables)
+            lengths = np.concatenate([np.diff(t.offsets[f]) for t in tables])
+            offsets[f] = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[f][1:])
+        ints = dict((f, np.concatenate([t.ints[f] for t in tables])) for f in tables[0].ints)
+        missing = dict((f, np.concatenate([t.missing[f] for t in tables])) for f in tables[0].missing)
+        return cls(fields, buffers, offsets, ints, missing)
+
+    def __len__(self):
+        if len(self.fields) == 0:
+            return 0
+        return len(self.offsets[self.fields[0]]) - 1
+
+    def get(self, field, i):
+        offsets = self.offsets[field]
+        return self.buffers[field][offsets[i]:offsets[i + 1]]
+
+    def row(self, i):
+        return dict((f, self.get(f, i)) for f in self.fields)
+
+    def rows(self, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        for i in indices:
+            yield self.row(i)
+
+    def column(self, field):
+        return [self.get(field, i) for i in range(len(self))]
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        buffers = {}
+        offsets = {}
+        for f in self.fields:
+            buffers[f] = ''.join(self.get(f, i) for i in indices)
+            offsets[f] = np.zeros(len(indices) + 1, dtype=np.int64)
+            np.cumsum(np.diff(self.offsets[f])[indices], out=offsets[f][1:])
+        ints = dict((f, a[indices]) for f, a in self.ints.items())
+        missing = dict((f, a[indices]) for f, a in self.missing.items())
+        return LinkTable(self.fields, buffers, offsets, ints, missing)
+
+    # row indices by field, highest first, empty values sort as default. ties
+    # keep table order like sorted(..., reverse=True) does
+    def sort_order(self, field, default=0):
+        keys = np.where(self.missing[field], default, self.ints[field])
+        return np.argsort(-keys, kind='stable')
+
+    # min_score and min_comments are combined as an OR when both are set, keep
+    # high score low comments and high comment low score links/posts
+    def valid_mask(self, min_score=0, min_comments=0):
+        if 'id' not in self.fields:
+            return np.zeros(len(self), dtype=bool)
+        mask = np.ones(len(self), dtype=bool)
+        if min_score > 0 and min_comments > 0:
+            mask &= (self.ints['score'] >= min_score) | (self.ints['num_comments'] >= min_comments)
+        else:
+            if min_score > 0:
+                mask &= self.ints['score'] >= min_score
+            if min_comments > 0:
+                mask &= self.ints['num_comments'] >= min_comments
+        return mask
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import time
+
+# alternative to the r/ directory tree, every page, search shard, media file
+# and static file of an archive in one sqlite file. paths are relative to r/,
+# e.g. alpha/index.html. write_html.py --pack writes it, serve_pack.py serves it
+pack_commit_every = 1000
+
+packs = {}
+
+def get_pack(pack_path):
+    if pack_path not in packs:
+        if os.path.dirname(pack_path):
+            os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+        db = sqlite3.connect(pack_path, timeout=60, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, data BLOB, mtime REAL)')
+        db.commit()
+        packs[pack_path] = {'db': db, 'pending': 0}
+    return packs[pack_path]['db']
+
+def open_pack(pack_path):
+    if not os.path.isfile(pack_path):
+        raise IOError('no pack file ' + pack_path)
+    return get_pack(pack_path)
+
+def write_file(pack_path, path, data, mtime=None):
+    if mtime is None:
+        mtime = time.time()
+    get_pack(pack_path).execute('INSERT OR REPLACE INTO files (path, data, mtime) VALUES (?, ?, ?)', (path, data, mtime))
+    packs[pack_path]['pending'] += 1
+    if packs[pack_path]['pending'] >= pack_commit_every:
+        commit(pack_path)
+
+def commit(pack_path):
+    if pack_path in packs and packs[pack_path]['pending'] > 0:
+        packs[pack_path]['db'].commit()
+        packs[pack_path]['pending'] = 0
+
+def read_file(pack_path, path):
+    row = get_pack(pack_path).execute('SELECT data FROM files WHERE path = ?', (path,)).fetchone()
+    if row is None:
+        return None
+    return bytes(row[0])
+
+# (size, mtime) or None if the file is not in the pack
+def get_file_info(pack_path, path):
+    row = get_pack(pack_path).execute('SELECT length(data), mtime FROM files WHERE path = ?', (path,)).fetchone()
+    if row is None:
+        return None
+    return row[0], row[1]
+
+# size bytes from start, for http range requests. an incremental blob read
+# only touches the pages of the range, substr() before python 3.11 loads the
+# whole blob first
+def read_file_range(pack_path, path, start, size):
+    db = get_pack(pack_path)
+    if not hasattr(db, 'blobopen'):
+        row = db.execute('SELECT substr(data, ?, ?) FROM files WHERE path = ?', (start + 1, size, path)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+    row = db.execute('SELECT rowid FROM files WHERE path = ?', (path,)).fetchone()
+    if row is None:
+        return None
+    with db.blobopen('files', 'data', row[0], readonly=True) as blob:
+        blob.seek(min(start, len(blob)))
+        return blob.read(size)
+
+def remove_file(pack_path, path):
+    get_pack(pack_path).execute('DELETE FROM files WHERE path = ?', (path,))
+    packs[pack_path]['pending'] += 1
+
+# file names directly below a directory path
+def list_dir(pack_path, path):
+    prefix = path.rstrip('/') + '/'
+    rows = get_pack(pack_path).execute('SELECT path FROM files WHERE path > ? AND path < ?', (prefix, prefix + '\uffff'))
+    return [row[0][len(prefix):] for row in rows if '/' not in row[0][len(prefix):]]
@@ -0,0 +1,224 @@
+// client side search over the static index shards written by write_html.py.
+// shards are plain scripts that call archiveSearchTerms() / archiveSearchDocs(),
+// that way they also load from file:// where ajax requests are blocked
+var archiveSearch = {
+  index: null,
+  termShards: {},
+  docShards: {},
+  results: [],
+  shown: 0,
+  pageSize: 100,
+  prefixLength: 2,
+  minTermLength: 2,
+  maxTermLength: 32
+};
+
+// shards split by longer prefixes and terms left out of the index
+function archiveSearchIndex(index) {
+  archiveSearch.index = index;
+}
+
+function archiveSearchTerms(name, terms) {
+  archiveSearch.termShards[name] = terms;
+}
+
+function archiveSearchDocs(num, docs) {
+  archiveSearch.docShards[num] = docs;
+}
+
+$(document).ready(function() {
+  var $search = $('#search');
+  var path = $search.data('path');
+  var docsPerShard = parseInt($search.data('docs-per-shard'));
+  var termPattern = /[0-9a-z_]+/g;
+  try {
+    termPattern = new RegExp('[\\p{L}\\p{N}_]+', 'gu');
+  } catch (e) {
+  }
+
+  // same as get_search_terms() and get_search_shard_name() in write_html.py
+  function getTerms(query) {
+    var terms = [];
+    var matches = query.toLowerCase().match(termPattern) || [];
+    for (var i = 0; i < matches.length; i++) {
+      var length = Array.from(matches[i]).length;
+      if (length >= archiveSearch.minTermLength && length <= archiveSearch.maxTermLength && terms.indexOf(matches[i]) == -1) {
+        terms.push(matches[i]);
+      }
+    }
+    return terms;
+  }
+
+  function getPrefixName(chars) {
+    var name = '';
+    for (var i = 0; i < chars.length; i++) {
+      if (/^[0-9a-z]$/.test(chars[i])) {
+        name += chars[i];
+      } else {
+        name += '_' + chars[i].codePointAt(0).toString(16) + '_';
+      }
+    }
+    return name;
+  }
+
+  // same as write_search_prefix() in write_html.py, terms longer than the
+  // prefix of a split shard are in the shard of the next longer prefix
+  function getShardName(term) {
+    var chars = Array.from(term);
+    var length = archiveSearch.prefixLength;
+    var name = getPrefixName(chars.slice(0, length));
+    while (archiveSearch.index.splits.indexOf(name) != -1 && chars.length > length) {
+      length++;
+      name = getPrefixName(chars.slice(0, length));
+    }
+    return name;
+  }
+
+  function loadScript(src, callback) {
+    var script = document.createElement('script');
+    script.src = src;
+    script.onload = script.onerror = callback;
+    document.head.appendChild(script);
+  }
+
+  function loadIndex(callback) {
+    if (archiveSearch.index) {
+      callback();
+      return;
+    }
+    loadScript(path + 'index.js', function() {
+      if (!archiveSearch.index) {
+        archiveSearch.index = {splits: [], stopwords: []};
+      }
+      callback();
+    });
+  }
+
+  // loads the shard scripts that are not loaded yet, missing shards count as empty
+  function loadShards(shards, dir, names, callback) {
+    var waiting = 0;
+    var loading = [];
+    names.forEach(function(name) {
+      if (name in shards || loading.indexOf(name) != -1) {
+        return;
+      }
+      loading.push(name);
+      waiting++;
+      loadScript(path + dir + '/' + name + '.js', function() {
+        if (!(name in shards)) {
+          shards[name] = dir == 't' ? {} : [];
+        }
+        waiting--;
+        if (waiting == 0) {
+          callback();
+        }
+      });
+    });
+    if (waiting == 0) {
+      callback();
+    }
+  }
+
+  function getDocIds(term) {
+    var deltas = archiveSearch.termShards[getShardName(term)][term] || [];
+    var ids = [];
+    var id = 0;
+    for (var i = 0; i < deltas.length; i++) {
+      id += deltas[i];
+      ids.push(id);
+    }
+    return ids;
+  }
+
+  function intersect(a, b) {
+    var result = [];
+    var i = 0;
+    var j = 0;
+    while (i < a.length && j < b.length) {
+      if (a[i] < b[j]) {
+        i++;
+      } else if (a[i] > b[j]) {
+        j++;
+      } else {
+        result.push(a[i]);
+        i++;
+        j++;
+      }
+    }
+    return result;
+  }
+
+  function showResults() {
+    var ids = archiveSearch.results.slice(archiveSearch.shown, archiveSearch.shown + archiveSearch.pageSize);
+    var shards = [];
+    ids.forEach(function(id) {
+      var shard = Math.floor(id / docsPerShard);
+      if (shards.indexOf(shard) == -1) {
+        shards.push(shard);
+      }
+    });
+    loadShards(archiveSearch.docShards, 'd', shards, function() {
+      var $links = $('#search-results');
+      ids.forEach(function(id) {
+        var doc = archiveSearch.docShards[Math.floor(id / docsPerShard)][id % docsPerShard];
+        if (doc) {
+          $links.append($('<a class="title mb-1"></a>').attr('href', doc[1]).html(doc[0]));
+        }
+      });
+      archiveSearch.shown += ids.length;
+      $('#search-more').toggleClass('d-none', archiveSearch.shown >= archiveSearch.results.length);
+    });
+  }
+
+  // every term has to match, newest posts first. stopwords are in too many
+  // posts to be indexed and are skipped
+  function search(query) {
+    var terms = getTerms(query);
+    $('#search-results').empty();
+    $('#search-more').addClass('d-none');
+    archiveSearch.results = [];
+    archiveSearch.shown = 0;
+    if (terms.length == 0) {
+      $('#search-status').text('');
+      return;
+    }
+    $('#search-status').text('searching...');
+    loadIndex(function() {
+      var stopwords = archiveSearch.index.stopwords;
+      terms = terms.filter(function(term) {
+        return stopwords.indexOf(term) == -1;
+      });
+      if (terms.length == 0) {
+        $('#search-status').text('these words are too common to search for, add another one');
+        return;
+      }
+      loadShards(archiveSearch.termShards, 't', terms.map(getShardName), function() {
+        var ids = getDocIds(terms[0]);
+        for (var i = 1; i < terms.length; i++) {
+          ids = intersect(ids, getDocIds(terms[i]));
+        }
+        archiveSearch.results = ids.reverse();
+        $('#search-status').text(ids.length + (ids.length == 1 ? ' post' : ' posts'));
+        showResults();
+      });
+    });
+  }
+
+  $('#search-form').submit(function(e) {
+    e.preventDefault();
+    var query = $('#search-query').val();
+    if (window.history.replaceState) {
+      window.history.replaceState(null, '', '#' + encodeURIComponent(query));
+    }
+    search(query);
+  });
+  $('#search-more').click(function() {
+    showResults();
+  });
+
+  if (window.location.hash.length > 1) {
+    var query = decodeURIComponent(window.location.hash.substring(1));
+    $('#search-query').val(query);
+    search(query);
+  }
+});
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+import argparse
+import mimetypes
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlsplit
+
+import pack_storage
+
+# serves an archive written by write_html.py --pack, the way a static server
+# serves r/. pages with a .gz copy are sent compressed to clients that accept
+# it, single byte ranges are answered from the blob without reading all of it
+# on python 3.11 and later, see pack_storage.read_file_range()
+pack_path = None
+pack_lock = threading.Lock()
+byte_range = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def get_pack_key(url_path):
+    path = unquote(urlsplit(url_path).path).lstrip('/')
+    if path == '' or path.endswith('/'):
+        path += 'index.html'
+    if '..' in path.split('/'):
+        return None
+    return path
+
+def get_content_type(key):
+    content_type = mimetypes.guess_type(key)[0]
+    if content_type is None:
+        return 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ['application/javascript', 'application/json']:
+        content_type += '; charset=utf-8'
+    return content_type
+
+# (start, end) inclusive, None without a usable range header, False if it can't be satisfied
+def parse_range(header, size):
+    if header is None:
+        return None
+    match = byte_range.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    else:
+        start = int(match.group(1))
+        end = size - 1
+        if match.group(2) != '':
+            end = min(int(match.group(2)), size - 1)
+    if start >= size or start > end:
+        return False
+    return start, end
+
+class PackHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_file(True)
+
+    def do_HEAD(self):
+        self.send_file(False)
+
+    def send_file(self, with_body):
+        key = get_pack_key(self.path)
+        if key is None:
+            self.send_error(404)
+            return
+        with pack_lock:
+            info = pack_storage.get_file_info(pack_path, key)
+            if info is None and not key.endswith('index.html'):
+                # directory url without the trailing slash
+                if pack_storage.get_file_info(pack_path, key + '/index.html') is not None:
+                    self.send_response(301)
+                    self.send_header('Location', '/' + key + '/')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            gz_info = None
+            if info is not None and 'Range' not in self.headers and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                gz_info = pack_storage.get_file_info(pack_path, key + '.gz')
+        if info is None:
+            self.send_error(404)
+            return
+
+        size = info[0]
+        content_range = parse_range(self.headers.get('Range'), size)
+        if content_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%s' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if gz_info is not None:
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+            read_key, start, length = key + '.gz', 0, gz_info[0]
+        elif content_range is not None:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (content_range[0], content_range[1], size))
+            read_key, start, length = key, content_range[0], content_range[1] - content_range[0] + 1
+        else:
+            self.send_response(200)
+            read_key, start, length = key, 0, size
+        self.send_header('Content-Type', get_content_type(key))
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if not with_body:
+            return
+        with pack_lock:
+            data = pack_storage.read_file_range(pack_path, read_key, start, length)
+        self.wfile.write(data)
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('pack', help='archive file written by write_html.py --pack')
+    parser.add_argument('--port', default=8000, help='default 8000', type=int)
+    parser.add_argument('--bind', default='127.0.0.1', help='address to listen on, default 127.0.0.1')
+    args=parser.parse_args()
+
+    pack_path = args.pack
+    pack_storage.open_pack(pack_path)
+    server = ThreadingHTTPServer((args.bind, args.port), PackHandler)
+    print('serving %s at http://%s:%s/' % (pack_path, args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+from datetime import datetime, date, timedelta
+import argparse
+import csv
+import os
+import sqlite3
+
+# alternative to the data/<sub>/YYYY/MM/DD csv tree, one indexed sqlite file
+# per subreddit. fetch_links.py writes to it and write_html.py reads from it
+# when data/<sub>/links.sqlite exists.
+db_filename = 'links.sqlite'
+
+link_fields = ['author', 'created_utc', 'domain', 'id', 'is_self',
+    'num_comments', 'over_18', 'permalink', 'retrieved_on', 'score',
+    'selftext', 'stickied', 'subreddit_id', 'title', 'url']
+comment_fields = ['author', 'body', 'created_utc', 'id', 'link_id',
+    'parent_id', 'score', 'stickied', 'subreddit_id']
+
+dbs = {}
+
+def get_db_path(subreddit):
+    return 'data/' + subreddit + '/' + db_filename
+
+def db_exists(subreddit):
+    return os.path.isfile(get_db_path(subreddit))
+
+# values are stored as text exactly like the csv files hold them, created_ts
+# and link are extra indexed columns for range scans and comment lookups
+def get_db(subreddit):
+    if subreddit not in dbs:
+        os.makedirs('data/' + subreddit, exist_ok=True)
+        db = sqlite3.connect(get_db_path(subreddit))
+        db.execute('CREATE TABLE IF NOT EXISTS links (created_ts INTEGER, %s, PRIMARY KEY (id))' % ', '.join(f + ' TEXT' for f in link_fields))
+        db.execute('CREATE INDEX IF NOT EXISTS links_created_ts ON links (created_ts)')
+        db.execute('CREATE TABLE IF NOT EXISTS comments (link TEXT, %s, PRIMARY KEY (link, id))' % ', '.join(f + ' TEXT' for f in comment_fields))
+        db.commit()
+        dbs[subreddit] = db
+    return dbs[subreddit]
+
+def to_text(value):
+    if value is None:
+        return ''
+    return str(value)
+
+def get_created_ts(link):
+    return int(float(link['created_utc']))
+
+# skips links and comments that are already stored, like the csv writer.
+# returns the number of links and comments written
+def write_links(subreddit, links):
+    db = get_db(subreddit)
+    wrote_links = 0
+    wrote_comments = 0
+    link_sql = 'INSERT OR IGNORE INTO links (created_ts, %s) VALUES (?, %s)' % (', '.join(link_fields), ', '.join('?' for f in link_fields))
+    comment_sql = 'INSERT OR IGNORE INTO comments (link, %s) VALUES (?, %s)' % (', '.join(comment_fields), ', '.join('?' for f in comment_fields))
+    with db:
+        for r in links:
+            cursor = db.execute(link_sql, [get_created_ts(r)] + [to_text(r.get(f)) for f in link_fields])
+            wrote_links += cursor.rowcount
+            for c in r.get('comments', []):
+                cursor = db.execute(comment_sql, [r['id']] + [to_text(c.get(f)) for f in comment_fields])
+                wrote_comments += cursor.rowcount
+    return wrote_links, wrote_comments
+
+def link_exists(subreddit, link_id):
+    if not db_exists(subreddit):
+        return False
+    row = get_db(subreddit).execute('SELECT 1 FROM links WHERE id = ?', (link_id,)).fetchone()
+    return row is not None
+
+# dates that have links, oldest first
+def get_link_dates(subreddit):
+    rows = get_db(subreddit).execute('SELECT DISTINCT created_ts / 86400 FROM links ORDER BY 1')
+    return [date(1970, 1, 1) + timedelta(days=row[0]) for row in rows]
+
+# same rows as load_links() in write_html.py returns for the csv tree
+def load_links(date, subreddit, with_comments=False):
+    db = get_db(subreddit)
+    day_ts = int((datetime(date.year, date.month, date.day) - datetime(1970, 1, 1)).total_seconds())
+    links = []
+    rows = db.execute('SELECT %s FROM links WHERE created_ts >= ? AND created_ts < ? ORDER BY rowid' % ', '.join(link_fields), (day_ts, day_ts + 86400))
+    for row in rows:
+        link_row = dict(zip(link_fields, row))
+        if with_comments is True or (with_comments and with_comments(link_row)):
+            comment_rows = db.execute('SELECT %s FROM comments WHERE link = ? ORDER BY rowid' % ', '.join(comment_fields), (link_row['id'],))
+            link_row['comments'] = [dict(zip(comment_fields, comment_row)) for comment_row in comment_rows]
+        links.append(link_row)
+    return links
+
+# converts an existing data/<sub>/YYYY/MM/DD csv tree
+def import_csv(subreddit):
+    sub_path = 'data/' + subreddit
+    imported_links = 0
+    imported_comments = 0
+    for dirpath, dirnames, filenames in os.walk(sub_path):
+        dirnames.sort()
+        if 'links.csv' not in filenames:
+            continue
+        links = []
+        with open(dirpath + '/links.csv', 'r', encoding='utf-8') as links_file:
+            reader = csv.DictReader(links_file)
+            for link_row in reader:
+                comments = []
+                comments_file_path = dirpath + '/' + link_row['id'] + '.csv'
+                if os.path.isfile(comments_file_path):
+                    with open(comments_file_path, 'r', encoding='utf-8') as comments_file:
+                        for comment_row in csv.DictReader(comments_file):
+                            comments.append(comment_row)
+                link_row['comments'] = comments
+                links.append(link_row)
+        wrote_links, wrote_comments = write_links(subreddit, links)
+        imported_links += wrote_links
+        imported_comments += wrote_comments
+        print('%s: imported %s links and %s comments' % (dirpath, wrote_links, wrote_comments))
+    print('%s: imported %s links and %s comments to %s' % (subreddit, imported_links, imported_comments, get_db_path(subreddit)))
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='import fetched csv data into ' + db_filename + ' files')
+    parser.add_argument('subreddit', nargs='*', help='subreddits to import, default all in data')
+    args=parser.parse_args()
+
+    subs = [sub.lower() for sub in args.subreddit]
+    if len(subs) == 0 and os.path.isdir('data'):
+        subs = [d for d in sorted(os.listdir('data')) if os.path.isdir('data/' + d)]
+    for sub in subs:
+        import_csv(sub)
@@ -8,6 +8,27 @@ import snudown
 import psutil
 import configparser, json, requests
 import pdb, sys, traceback
+import multiprocessing
+import hashlib
+import shutil, tempfile
+import threading
+import sqlite3, time
+import functools
+import contextlib, cProfile
+import gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import resource
+except ImportError:
+    resource = None # windows
+import sqlite_storage
+import pack_storage
+import numpy as np
+from link_table import LinkTable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 url_project = 'https://github.com/libertysoft3/reddit-html-archiver'
 links_per_page = 30
@@ -34,77 +55,557 @@ sort_indexes = {
     }
 }
 missing_comment_score_label = 'n/a'
+user_shards = 64
+user_shard_max_bytes = 32 * 1024 * 1024 # larger shards are split before loading
+user_shard_splits = 16
+user_split_open_files = 16 # split files open at once, more splits read the shard again
+media_workers = 8
+media_timeout = (10, 30) # connect, read seconds
+imgur_api_url = 'https://api.imgur.com/3/image/'
+# fields subreddit and user pages are rendered from
+index_link_fields = ['author', 'id', 'score', 'num_comments', 'created_utc',
+    'title', 'url', 'permalink', 'is_self']
+user_link_fields = ['author', 'subreddit', 'id', 'score', 'num_comments', 'created_utc',
+    'title', 'url', 'permalink', 'is_self']
+
+
+cache_dir = 'cache'
+template_cache_file = cache_dir + '/templates.json'
+manifest_file = cache_dir + '/manifest.sqlite'
+media_cache_file = cache_dir + '/media.sqlite'
+media_cache_ttl = 365 * 86400
+media_cache_negative_ttl = 7 * 86400 # urls that were gone or not an image
+markdown_cache_file = cache_dir + '/markdown.sqlite'
+markdown_cache_size = 100000 # rendered bodies kept in memory per process
+markdown_cache_commit_every = 1000
+report_file = cache_dir + '/report.json'
+profile_dir = cache_dir + '/profile'
+shards_dir = 'shards' # --shard output for --merge
+progress_interval = 30 # seconds between progress lines
+search_term = re.compile(r'\w+')
+search_min_term_length = 2
+search_max_term_length = 32
+search_prefix_length = 2 # terms are sharded by their first characters
+search_max_prefix_length = 6 # larger shards are split by longer prefixes up to this
+search_shard_max_bytes = 256 * 1024 # postings in the spill file of a shard before it is split
+search_spill_postings = 200000 # postings held in memory before they are appended to the spill
+search_stopword_min_docs = 2000
+search_stopword_ratio = 0.2 # terms in more of a subreddit's posts are left out, queries skip them
+search_shard_chars = 'abcdefghijklmnopqrstuvwxyz0123456789'
+search_docs_per_shard = 500
+minify_preserve = re.compile(r'(<(pre|textarea|script)[\s>].*?</\2>)', re.S | re.I)
+minify_whitespace = re.compile(r'[ \t\r]*\n\s*')
+compress_min_size = 512 # bytes, smaller pages are served as they are
+compress_chunk_size = 1000 # pages held in memory by the compress stage
+output_batch_files = 200 # files buffered before they are written
+output_batch_bytes = 8 * 1048576
+template_placeholder = re.compile(r'(###[A-Z_]+###|#[A-Z_]+#)')
+template_files = {
+    'index':                'templates/index.html',
+    'subreddit':            'templates/subreddit.html',
+    'link':                 'templates/link.html',
+    'comment':              'templates/partial_comment.html',
+    'search':               'templates/search.html',
+    'user':                 'templates/user.html',
+    'sub_link':             'templates/partial_menu_item.html',
+    'user_url':             'templates/partial_user.html',
+    'link_url':             'templates/partial_link.html',
+    'index_sub':            'templates/partial_index_subreddit.html',
+    'index_pager_link':     'templates/partial_subreddit_pager_link.html',
+    'selftext':             'templates/partial_link_selftext.html',
+    'user_page_link':       'templates/partial_user_link.html',
+    'url':                  'templates/partial_url.html',
+}
 
-
-template_index = ''
-with open('templates/index.html', 'r', encoding='utf-8') as file:
-    template_index = file.read()
-
-template_subreddit = ''
-with open('templates/subreddit.html', 'r', encoding='utf-8') as file:
-    template_subreddit = file.read()
-
-template_link = ''
-with open('templates/link.html', 'r', encoding='utf-8') as file:
-    template_link = file.read()
-
-template_comment = ''
-with open('templates/partial_comment.html', 'r', encoding='utf-8') as file:
-    template_comment = file.read()
-
-template_search = ''
-with open('templates/search.html', 'r', encoding='utf-8') as file:
-    template_search = file.read()
-
-template_user = ''
-with open('templates/user.html', 'r', encoding='utf-8') as file:
-    template_user = file.read()
-
-template_sub_link = ''
-with open('templates/partial_menu_item.html', 'r', encoding='utf-8') as file:
-    template_sub_link = file.read()
-
-template_user_url = ''
-with open('templates/partial_user.html', 'r', encoding='utf-8') as file:
-    template_user_url = file.read()
-
-template_link_url = ''
-with open('templates/partial_link.html', 'r', encoding='utf-8') as file:
-    template_link_url = file.read()
-
-template_search_link = ''
-with open('templates/partial_search_link.html', 'r', encoding='utf-8') as file:
-    template_search_link = file.read()
-
-template_index_sub = ''
-with open('templates/partial_index_subreddit.html', 'r', encoding='utf-8') as file:
-    template_index_sub = file.read()
-
-template_index_pager_link = ''
-with open('templates/partial_subreddit_pager_link.html', 'r', encoding='utf-8') as file:
-    template_index_pager_link = file.read()
-
-template_selftext = ''
-with open('templates/partial_link_selftext.html', 'r', encoding='utf-8') as file:
-    template_selftext = file.read()
-
-template_user_page_link = ''
-with open('templates/partial_user_link.html', 'r', encoding='utf-8') as file:
-    template_user_page_link = file.read()
-
-teplate_url = ''
-with open('templates/partial_url.html', 'r', encoding='utf-8') as file:
-    template_url = file.read()
+# templates are compiled to a list alternating literal text and placeholder
+# keys, literals at even and keys at odd indexes, so a page renders with one join
+def compile_template(html):
+    return template_placeholder.split(html)
+
+def render_template(template, data_map):
+    parts = list(template)
+    for i in range(1, len(parts), 2):
+        if parts[i] in data_map:
+            parts[i] = data_map[parts[i]]
+    return ''.join(parts)
+
+# compiled templates are cached on disk by file mtime and size
+def load_templates():
+    cache = {}
+    if os.path.isfile(template_cache_file):
+        try:
+            with open(template_cache_file, 'r', encoding='utf-8') as file:
+                cache = json.load(file)
+        except ValueError:
+            cache = {}
+
+    templates = {}
+    changed = False
+    for name, path in template_files.items():
+        stat = os.stat(path)
+        cached = cache.get(path)
+        if cached and cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            templates[name] = cached['template']
+            continue
+        with open(path, 'r', encoding='utf-8') as file:
+            templates[name] = compile_template(file.read())
+        cache[path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'template': templates[name]}
+        changed = True
+
+    if changed:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(template_cache_file, 'w', encoding='utf-8') as file:
+            json.dump(cache, file)
+    return templates
+
+templates = load_templates()
+templates_hash = hashlib.sha1(json.dumps(templates, sort_keys=True).encode('utf-8')).hexdigest()
+template_index = templates['index']
+template_subreddit = templates['subreddit']
+template_link = templates['link']
+template_comment = templates['comment']
+template_search = templates['search']
+template_user = templates['user']
+template_sub_link = templates['sub_link']
+template_user_url = templates['user_url']
+template_link_url = templates['link_url']
+template_index_sub = templates['index_sub']
+template_index_pager_link = templates['index_pager_link']
+template_selftext = templates['selftext']
+template_user_page_link = templates['user_page_link']
+template_url = templates['url']
+
+# output page path -> signature of the inputs it was rendered from, kept in
+# sqlite so memory doesn't grow with the archive. pages whose signature is
+# unchanged are skipped, pages not produced this run are deleted. changes are
+# committed by save_manifest() once the pages are written
+manifest = {}
+
+# pages in a pack, of a shard and of the merge step are tracked apart from
+# the ones of a whole archive in r/
+def get_manifest_path():
+    name = ''
+    if args.pack:
+        name += '-' + os.path.basename(args.pack)
+    if args.shard:
+        name += '-shard-%s-of-%s' % args.shard
+    if args.merge:
+        name += '-merge'
+    if name == '':
+        return manifest_file
+    return cache_dir + '/manifest' + name + '.sqlite'
+
+def open_manifest(manifest_path):
+    db = sqlite3.connect(manifest_path)
+    db.execute('CREATE TABLE IF NOT EXISTS pages (path TEXT PRIMARY KEY, signature TEXT)')
+    db.commit()
+    return db
+
+def load_manifest():
+    if 'db' in manifest:
+        manifest.pop('db').close()
+    manifest_path = get_manifest_path()
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        db = open_manifest(manifest_path)
+    except sqlite3.DatabaseError:
+        print('Warning: ignoring unreadable %s, rebuilding all pages' % manifest_path)
+        os.remove(manifest_path)
+        db = open_manifest(manifest_path)
+    # pages produced this run, a temporary table is spilled to disk like the manifest
+    db.execute('CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)')
+    manifest['db'] = db
+
+    # manifests of earlier versions were json
+    json_path = os.path.splitext(manifest_path)[0] + '.json'
+    if os.path.isfile(json_path):
+        try:
+            with open(json_path, 'r', encoding='utf-8') as file:
+                db.executemany('INSERT OR IGNORE INTO pages (path, signature) VALUES (?, ?)', json.load(file).items())
+            db.commit()
+        except ValueError:
+            print('Warning: ignoring unreadable %s' % json_path)
+        os.remove(json_path)
+
+# records the page for this run, returns True if it can be left as is
+def page_is_current(filepath, signature):
+    db = manifest['db']
+    db.execute('INSERT OR IGNORE INTO seen (path) VALUES (?)', (filepath,))
+    row = db.execute('SELECT signature FROM pages WHERE path = ?', (filepath,)).fetchone()
+    if row is not None and row[0] == signature:
+        return get_output_info(filepath) is not None
+    set_page_signature(filepath, signature)
+    return False
+
+def set_page_signature(filepath, signature):
+    manifest['db'].execute('INSERT OR REPLACE INTO pages (path, signature) VALUES (?, ?)', (filepath, signature))
+
+# pages produced this run
+def get_run_pages():
+    return (row[0] for row in manifest['db'].execute('SELECT path FROM seen'))
+
+def save_manifest(stale_prefix='r/'):
+    # only pages under stale_prefix were considered in this run
+    db = manifest['db']
+    stale_range = (stale_prefix, stale_prefix + '\uffff')
+    stale_query = 'FROM pages WHERE path >= ? AND path < ? AND path NOT IN (SELECT path FROM seen)'
+    for (filepath,) in db.execute('SELECT path ' + stale_query, stale_range):
+        if get_output_info(filepath) is not None:
+            remove_output_file(filepath)
+            print('removed stale %s' % filepath)
+            for ext in ['.gz', '.br']:
+                if get_output_info(filepath + ext) is not None:
+                    remove_output_file(filepath + ext)
+    db.execute('DELETE ' + stale_query, stale_range)
+    if args.pack:
+        pack_storage.commit(args.pack)
+    db.commit()
+
+def get_signature(*inputs):
+    filters = [args.min_score, args.min_comments, args.hide_deleted_comments, args.noimages]
+    if args.minify:
+        # only added when set so existing signatures stay valid
+        filters.append('minify')
+    data = json.dumps([templates_hash, url_project, filters, inputs], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+# pages are the rendered html pages, compressed copies, media and search
+# shards only count as files
+def write_page(filepath, html):
+    if filepath.endswith('.html'):
+        count_stat('pages')
+        if args.minify:
+            html = minify_html(html)
+    write_output_file(filepath, html.encode('utf-8'))
+
+# everything below r/ is written through these, either to files or with --pack
+# to one sqlite file, see pack_storage.py. worker processes don't write to the
+# pack, they hand their pages to the parent, see write_link_pages()
+deferred_output = None
+
+# files are buffered and written in batches, sorted so a directory's files
+# are written together. directories known to exist aren't created again and
+# every file is written to a temporary file and renamed, an interrupted run
+# leaves old or new pages but no truncated ones. reads see buffered files
+output_buffer = {} # filepath -> data not written yet
+output_buffer_size = {'bytes': 0}
+output_dirs = set()
+
+def get_pack_path(filepath):
+    return filepath[len('r/'):]
+
+def write_output_file(filepath, data):
+    if args.pack and deferred_output is not None:
+        deferred_output.append((filepath, data))
+        return
+    count_stat('files')
+    count_stat('bytes', len(data))
+    if args.pack:
+        pack_storage.write_file(args.pack, get_pack_path(filepath), data)
+        return
+    output_buffer[filepath] = data
+    output_buffer_size['bytes'] += len(data)
+    if len(output_buffer) >= output_batch_files or output_buffer_size['bytes'] >= output_batch_bytes:
+        flush_output()
+
+def flush_output():
+    for filepath in sorted(output_buffer):
+        write_file_atomic(filepath, output_buffer[filepath])
+    output_buffer.clear()
+    output_buffer_size['bytes'] = 0
+
+def write_file_atomic(filepath, data):
+    dirpath = os.path.dirname(filepath)
+    if dirpath not in output_dirs:
+        os.makedirs(dirpath, exist_ok=True)
+        output_dirs.add(dirpath)
+    tmp_path = filepath + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_deferred_output(files):
+    for filepath, data in files:
+        write_output_file(filepath, data)
+
+def read_output_file(filepath):
+    if args.pack:
+        return pack_storage.read_file(args.pack, get_pack_path(filepath))
+    if filepath in output_buffer:
+        return output_buffer[filepath]
+    with open(filepath, 'rb') as file:
+        return file.read()
+
+# (size, mtime) or None if there is no such file
+def get_output_info(filepath):
+    if args.pack:
+        return pack_storage.get_file_info(args.pack, get_pack_path(filepath))
+    if filepath in output_buffer:
+        return len(output_buffer[filepath]), time.time()
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+def remove_output_file(filepath):
+    if args.pack:
+        pack_storage.remove_file(args.pack, get_pack_path(filepath))
+        return
+    if filepath in output_buffer:
+        output_buffer_size['bytes'] -= len(output_buffer.pop(filepath))
+    if not os.path.isfile(filepath):
+        return
+    os.remove(filepath)
+    try:
+        os.removedirs(os.path.dirname(filepath))
+    except OSError:
+        pass
+    # parents may be gone too
+    output_dirs.clear()
+
+def list_output_dir(path):
+    if args.pack:
+        return pack_storage.list_dir(args.pack, get_pack_path(path))
+    names = set(os.path.basename(filepath) for filepath in output_buffer if os.path.dirname(filepath) == path)
+    if os.path.isdir(path):
+        names.update(os.listdir(path))
+    return sorted(names)
+
+# the pack also carries r/static, copied when it changed
+def pack_static_files():
+    for dirpath, dirnames, filenames in os.walk('r/static'):
+        for filename in filenames:
+            filepath = dirpath.replace(os.sep, '/') + '/' + filename
+            mtime = os.path.getmtime(filepath)
+            info = get_output_info(filepath)
+            if info is None or info[1] != mtime:
+                with open(filepath, 'rb') as file:
+                    pack_storage.write_file(args.pack, get_pack_path(filepath), file.read(), mtime)
+    pack_storage.commit(args.pack)
+
+# drops template indentation and blank lines. a line break is kept wherever
+# there was whitespace so inline elements keep their spacing, pre, textarea
+# and script content is left alone
+def minify_html(html):
+    parts = minify_preserve.split(html)
+    minified = ''
+    for i in range(0, len(parts), 3):
+        minified += minify_whitespace.sub('\n', parts[i])
+        if i + 1 < len(parts):
+            minified += parts[i + 1]
+    return minified.strip() + '\n'
+
+# writes .gz and, if the brotli module is installed, .br siblings of every
+# page written or kept this run whose siblings are missing or older
+# pages are read and written by this process, workers only compress
+def compress_pages(jobs=1):
+    filepaths = []
+    for filepath in get_run_pages():
+        info = get_output_info(filepath)
+        if info is None or info[0] < compress_min_size:
+            continue
+        for ext in get_compressed_extensions():
+            compressed_info = get_output_info(filepath + ext)
+            if compressed_info is None or compressed_info[1] < info[1]:
+                filepaths.append(filepath)
+                break
+    if len(filepaths) == 0:
+        return
+    print('compressing %s pages' % len(filepaths))
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+    for chunk in chunks(filepaths, compress_chunk_size):
+        pages = [read_output_file(filepath) for filepath in chunk]
+        if pool is None:
+            compressed_pages = [compress_page(page) for page in pages]
+        else:
+            compressed_pages = pool.map(compress_page, pages)
+        for filepath, compressed in zip(chunk, compressed_pages):
+            for ext, content in compressed.items():
+                write_output_file(filepath + ext, content)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def get_compressed_extensions():
+    if brotli is None:
+        return ['.gz']
+    return ['.gz', '.br']
+
+def compress_page(data):
+    compressed = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed['.br'] = brotli.compress(data)
+    return compressed
 
 process = psutil.Process(os.getpid())
+
+# highest rss of this process so far, including memory freed since.
+# ru_maxrss is in kilobytes, in bytes on macos
+def get_peak_rss():
+    if resource is None:
+        info = process.memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+# run statistics, per subreddit and '' for archive wide stages like user
+# pages. counters are summed, *_max values keep the highest. worker processes
+# collect their own and hand them to the parent with their pages, see
+# merge_worker_result()
+stats = {}
+stats_sub = ''
+stats_lock = threading.Lock()
+stats_started = time.time()
+stats_progress = {'printed': time.time()}
+profiles = {}
+active_profile = None
+
+def get_sub_stats(sub=None):
+    return stats.setdefault(stats_sub if sub is None else sub, {'stages': {}})
+
+def count_stat(name, value=1):
+    with stats_lock:
+        sub_stats = get_sub_stats()
+        sub_stats[name] = sub_stats.get(name, 0) + value
+
+def max_stat(name, value):
+    with stats_lock:
+        sub_stats = get_sub_stats()
+        sub_stats[name] = max(sub_stats.get(name, 0), value)
+
+def merge_stats(into, other):
+    for key, value in other.items():
+        if isinstance(value, dict):
+            merge_stats(into.setdefault(key, {}), value)
+        elif key.endswith('_max'):
+            into[key] = max(into.get(key, 0), value)
+        else:
+            into[key] = into.get(key, 0) + value
+
+# wall time, calls and rss high-water mark of a part of the run. with --profile
+# each stage also gets a cProfile written to cache/profile/<stage>.prof
+@contextlib.contextmanager
+def stage(name):
+    global active_profile
+    profile = None
+    if args.profile and active_profile is None:
+        profile = profiles.setdefault(name, cProfile.Profile())
+        active_profile = profile
+        profile.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profile is not None:
+            profile.disable()
+            active_profile = None
+        with stats_lock:
+            stage_stats = get_sub_stats()['stages'].setdefault(name, {'seconds': 0, 'calls': 0})
+            stage_stats['seconds'] += seconds
+            stage_stats['calls'] += 1
+        max_stat('rss_max', get_peak_rss())
+        print_progress()
+
+def print_progress(force=False):
+    # workers leave progress lines to the parent
+    if deferred_output is not None:
+        return
+    now = time.time()
+    if not force and now - stats_progress['printed'] < progress_interval:
+        return
+    stats_progress['printed'] = now
+    total = {}
+    for sub_stats in stats.values():
+        merge_stats(total, sub_stats)
+    elapsed = now - stats_started
+    print('progress %s: %s links, %s pages at %.1f pages/s, %s files with %.1f MB written, rss %.0f MB, now %s' % (
+        timedelta(seconds=int(elapsed)), total.get('links', 0), total.get('pages', 0), total.get('pages', 0) / max(elapsed, 0.001),
+        total.get('files', 0), total.get('bytes', 0) / 1048576, process.memory_info().rss / 1048576, stats_sub or 'archive pages'))
+
+def dump_profiles(suffix=''):
+    if not args.profile or len(profiles) == 0:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    for name, profile in profiles.items():
+        profile.dump_stats(profile_dir + '/' + name + suffix + '.prof')
+
+# pages and counters of a write_link_pages() task run in a worker
+def merge_worker_result(result):
+    global stats_sub
+    subreddit, files, worker_stats = result
+    with stats_lock:
+        merge_stats(stats, worker_stats)
+    previous_sub = stats_sub
+    stats_sub = subreddit
+    write_deferred_output(files)
+    stats_sub = previous_sub
+
+def get_report():
+    report = {'seconds': round(time.time() - stats_started, 3), 'subreddits': {}}
+    total = {}
+    for sub, sub_stats in sorted(stats.items()):
+        merge_stats(total, sub_stats)
+        if sub == '':
+            report['archive'] = get_stats_report(sub_stats)
+        else:
+            report['subreddits'][sub] = get_stats_report(sub_stats)
+    report['total'] = get_stats_report(total, report['seconds'])
+    return report
+
+def get_stats_report(sub_stats, seconds=None):
+    report = dict(sub_stats)
+    report['stages'] = dict((name, {'seconds': round(s['seconds'], 3), 'calls': s['calls']}) for name, s in sub_stats.get('stages', {}).items())
+    if seconds is None:
+        seconds = sum(s['seconds'] for s in sub_stats.get('stages', {}).values())
+    for key in ['markdown_seconds', 'media_seconds', 'media_seconds_max']:
+        if key in report:
+            report[key] = round(report[key], 3)
+    if seconds > 0 and report.get('pages'):
+        report['pages_per_second'] = round(report['pages'] / seconds, 1)
+    if report.get('media_fetches'):
+        report['media_seconds_mean'] = round(report['media_seconds'] / report['media_fetches'], 3)
+    if 'rss_max' in report:
+        report['rss_max_mb'] = round(report.pop('rss_max') / 1048576, 1)
+    return report
+
+def write_report():
+    report = get_report()
+    report_path = args.report or report_file
+    if os.path.dirname(report_path):
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    print('report written to %s' % report_path)
+
+# one keep-alive session per media thread, requests pools connections per host
+http_sessions = threading.local()
+def get_http_session():
+    if not hasattr(http_sessions, 'session'):
+        http_sessions.session = requests.Session()
+    return http_sessions.session
+
+# returns (extension, content) for an image, False if the url definitely has
+# no image and None if it failed in a way that may pass on a later run
 def retrieve_media(URL):
     try:
-        http = requests.get(URL)
+        http = get_http_session().get(URL, timeout=media_timeout)
     except (requests.exceptions.RequestException, UnicodeError) as e:
         print("Error failed to retrieve %s" % URL)
         print(e)
         return None
     
+    if http.status_code in [404, 410]: return False
     if http.status_code != 200: return None
     try:
         if 'Content-Type' not in http.headers:
@@ -115,7 +616,7 @@ def retrieve_media(URL):
         extension = headers.split("/")[1]
         content_type = headers.split("/")[0]
         if content_type != "image":
-            return None
+            return False
 
         return (extension, http.content)
     except IndexError as e:
@@ -125,13 +626,16 @@ def retrieve_media(URL):
     
 
 
+imgur_credentials = {}
 def get_imgur_credentials():
-    if os.path.isfile("credentials.ini"):
-        cfg = configparser.ConfigParser()
-        cfg.read("credentials.ini")
-        return str(cfg["MAIN"]['imgur_client_id'])
-    else:
-        return None
+    # read once per process
+    if 'client_id' not in imgur_credentials:
+        imgur_credentials['client_id'] = None
+        if os.path.isfile("credentials.ini"):
+            cfg = configparser.ConfigParser()
+            cfg.read("credentials.ini")
+            imgur_credentials['client_id'] = str(cfg["MAIN"]['imgur_client_id'])
+    return imgur_credentials['client_id']
 
 # Returns a pair of bools that determine whether or not the imgur link is an individual image or an album
 def is_imgur(URL):
@@ -144,12 +648,19 @@ def get_imgur_image_link(iURL):
         print("Warning: failed to retrieve imgur image link from %s" % iURL)
         print("Reason: No client id found")
         return None
-    URL = "https://api.imgur.com/3/image/" + iURL.split('/')[-1]
+    URL = imgur_api_url + iURL.split('/')[-1]
     
     header = {"Authorization": str("CLIENT-ID " + cid)}
-    r = requests.get(URL, headers=header)
+    try:
+        r = get_http_session().get(URL, headers=header, timeout=media_timeout)
+    except requests.exceptions.RequestException as e:
+        print("Error failed to retrieve %s" % URL)
+        print(e)
+        return None
     if r.status_code != 200:
         print("Error, %s on retrieving %s" % (r.status_code, URL))
+        if r.status_code in [404, 410]:
+            return False
         return None
     
     j = json.loads(r.text)['data']
@@ -157,73 +668,382 @@ def get_imgur_image_link(iURL):
         print(j['error'])
         return None
     return json.loads(r.text)['data']['link']
+
+# returns the resolved url and the image, resolved url is None if the result
+# shouldn't be cached
+def fetch_link_media(link):
+    start = time.perf_counter()
+    resolved_url, image = fetch_link_media_url(link)
+    seconds = time.perf_counter() - start
+    count_stat('media_fetches')
+    count_stat('media_seconds', seconds)
+    max_stat('media_seconds_max', seconds)
+    return resolved_url, image
+
+def fetch_link_media_url(link):
+    resolved_url = link['url']
+    i = is_imgur(link['url'])
+    # if we have an imgur client id and the url in the loop is an imgur link then get the URL
+    if i[0]:
+        if get_imgur_credentials() is None:
+            # asked again once the negative cache entry expires
+            return resolved_url, None
+        # Extract url from json and download the image itself
+        imu = get_imgur_image_link(link['url'])
+        if not imu:
+            return (resolved_url if imu is False else None), None
+        resolved_url = imu
+        image = retrieve_media(imu)
+    elif i[1]:
+        # TODO: Implement Imgur albums support
+        return resolved_url, None
+    else:
+        image = retrieve_media(link['url'])
+    # timeouts, connection errors, 429 and 5xx are retried on the next run
+    if image is None:
+        return None, None
+    if image is False:
+        return resolved_url, None
+    return resolved_url, image
+
+# url -> resolved url, content type and stored file, kept across runs.
+# path is NULL for urls without an image
+media_cache = {}
+def get_media_cache():
+    if 'db' not in media_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        db = sqlite3.connect(media_cache_file)
+        db.execute('CREATE TABLE IF NOT EXISTS media (url TEXT PRIMARY KEY, resolved_url TEXT, content_type TEXT, path TEXT, fetched INTEGER)')
+        now = int(time.time())
+        db.execute('DELETE FROM media WHERE fetched < ? OR (path IS NULL AND fetched < ?)', (now - media_cache_ttl, now - media_cache_negative_ttl))
+        db.commit()
+        media_cache['db'] = db
+        media_cache['stored'] = {}
+    return media_cache['db']
+
+# link id -> image filename of images already in r/<sub>/images, listed once per subreddit
+def get_stored_media(subreddit):
+    get_media_cache()
+    if subreddit not in media_cache['stored']:
+        stored = {}
+        for filename in list_output_dir('r/' + subreddit + '/images'):
+            stored[os.path.splitext(filename)[0]] = filename
+        media_cache['stored'][subreddit] = stored
+    return media_cache['stored'][subreddit]
+
+def store_media(subreddit, link_id, extension, content=None, source_path=None):
+    # URL + /images/ + ID + . Image Extension
+    media_path = subreddit + "/images/" + link_id + "." + extension
+    if source_path is not None:
+        content = read_output_file(source_path)
+    write_output_file("r/" + media_path, content)
+    print("Writing media: %s " % media_path)
+    get_stored_media(subreddit)[link_id] = os.path.basename(media_path)
+    return media_path
+
+# what fetch_media() would answer for a link without making requests, part of
+# the link page signature. 'pending' if the url has to be fetched, so failed
+# downloads and expired cache entries are tried again on the next run
+def get_media_state(link, subreddit):
+    db = get_media_cache()
+    stored = get_stored_media(subreddit)
+    row = db.execute('SELECT path FROM media WHERE url = ?', (link['url'],)).fetchone()
+    if row is not None and row[0] is None:
+        return 'none'
+    if link['id'] in stored:
+        return 'image:' + stored[link['id']]
+    if row is not None and get_output_info("r/" + row[0]) is not None:
+        return 'image:' + link['id'] + os.path.splitext(row[0])[1]
+    return 'pending'
+
+# one thread pool for the whole run, its threads keep their http sessions
+# from one day's batch to the next
+media_executor = {}
+def get_media_executor():
+    if 'executor' not in media_executor:
+        media_executor['executor'] = ThreadPoolExecutor(max_workers=media_workers)
+    return media_executor['executor']
+
+def close_media_executor():
+    if 'executor' in media_executor:
+        media_executor.pop('executor').shutdown()
+
+# media stage, downloads a batch of links' images on a thread pool before their
+# pages are rendered. returns link id -> path of the stored image relative to r/.
+# urls seen before are answered from the media cache without any requests
+def fetch_media(links, subreddit):
+    media = {}
+    db = get_media_cache()
+    stored = get_stored_media(subreddit)
+    downloads = []
+    for l in links:
+        row = db.execute('SELECT path FROM media WHERE url = ?', (l['url'],)).fetchone()
+        if row is not None and row[0] is None:
+            continue
+        if l['id'] in stored:
+            media[l['id']] = subreddit + "/images/" + stored[l['id']]
+        elif row is not None and get_output_info("r/" + row[0]) is not None:
+            # same url stored for another link
+            extension = os.path.splitext(row[0])[1][1:]
+            media[l['id']] = store_media(subreddit, l['id'], extension, source_path="r/" + row[0])
+        else:
+            downloads.append(l)
+
+    if len(downloads) > 0:
+        executor = get_media_executor()
+        futures = {executor.submit(fetch_link_media, l): l for l in downloads}
+        for future in as_completed(futures):
+            l = futures[future]
+            resolved_url, image = future.result()
+            media_path = None
+            content_type = None
+            if image is not None:
+                media_path = store_media(subreddit, l['id'], image[0], image[1])
+                content_type = 'image/' + image[0]
+                media[l['id']] = media_path
+            if resolved_url is not None:
+                db.execute('INSERT OR REPLACE INTO media (url, resolved_url, content_type, path, fetched) VALUES (?, ?, ?, ?, ?)',
+                    (l['url'], resolved_url, content_type, media_path, int(time.time())))
+        db.commit()
+    return media
     
 
-def generate_html(min_score=0, min_comments=0, hide_deleted_comments=False):
-    delta = timedelta(days=1)
+def generate_html(min_score=0, min_comments=0, hide_deleted_comments=False, jobs=1):
+    global stats_sub, stats_started
+    stats_started = time.time()
     subs = get_subs()
-    user_index = {}
+    load_manifest()
+
+    # user page links are spilled to disk by author hash and rendered shard by
+    # shard, with --shard they are kept for --merge
+    shard_path = None
+    if args.shard:
+        shard_path = get_shard_path(*args.shard)
+        print('rendering shard %s of %s' % args.shard)
+    user_spill_path, user_spill_files, user_spill_writers = open_user_spill(None if shard_path is None else shard_path + '/users')
     processed_subs = []
     stat_links = 0
     stat_filtered_links = 0
 
+    # render link pages in worker processes, a day of links per task
+    pool = None
+    pending_batches = []
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(args,))
+
     for sub in subs:
+        if args.sub != '-' and sub != args.sub.lower():
+            continue
         # write link pages
-        # print('generate_html() processing %s %s kb' % (sub, int(int(process.memory_info().rss) / 1024)))
+        stats_sub = sub
+        # the subreddit's shard writes its subreddit pages, search and user
+        # records and needs every link with its comments, only link pages are
+        # spread over all shards
+        owns_sub = owns_shard_key(sub)
+        owns_link = lambda l, sub=sub: owns_shard_key(sub + '/' + l['id'])
         stat_sub_links = 0
         stat_sub_filtered_links = 0
         stat_sub_comments = 0
-        d = start_date
-        while d <= end_date:
-            raw_links = load_links(d, sub, True)
+        sub_tables = []
+        search_spill = open_search_spill() if owns_sub else None
+        sub_hash = hashlib.sha1()
+        for d in get_link_dates(sub):
+            with stage('load_links'):
+                raw_links = load_links(d, sub, True if owns_sub else owns_link)
             stat_links += len(raw_links)
             stat_sub_links += len(raw_links)
-            for l in raw_links:
-                print("Writing: %s" % d)
-                if validate_link(l, min_score, min_comments):
-                    write_link_page(subs, l, sub, hide_deleted_comments)
-                    stat_filtered_links += 1
-                    stat_sub_filtered_links += 1
-                    if 'comments' in l:
-                        stat_sub_comments += len(l['comments'])
-            d += delta
+
+            with stage('filter_links'):
+                # filter the day's links at once and keep the valid ones for subreddit pages
+                day_table = LinkTable.from_links(raw_links, index_link_fields)
+                valid = day_table.valid_mask(min_score, min_comments)
+                if owns_sub:
+                    sub_tables.append(day_table.take(np.flatnonzero(valid)))
+                    count_stat('links', int(np.count_nonzero(valid)))
+
+                batch = []
+                for l, is_valid in zip(raw_links, valid):
+                    print("Writing: %s" % d)
+                    if is_valid and owns_link(l):
+                        if args.noimages:
+                            if not page_is_current(get_link_page_path(l), get_signature(subs, sub, l)):
+                                batch.append(l)
+                        else:
+                            media_state = get_media_state(l, sub)
+                            if not page_is_current(get_link_page_path(l), get_signature(subs, sub, l, media_state)) or media_state == 'pending':
+                                batch.append(l)
+                    if is_valid and owns_sub:
+                        add_search_terms(search_spill, stat_sub_filtered_links, l)
+                        stat_filtered_links += 1
+                        stat_sub_filtered_links += 1
+                        if 'comments' in l:
+                            stat_sub_comments += len(l['comments'])
+
+                        # signature input and user page record, without comments
+                        index_link = {k: v for k, v in l.items() if k != 'comments'}
+                        sub_hash.update(json.dumps(index_link, sort_keys=True).encode('utf-8'))
+
+                        # collect links for user pages
+                        index_link['subreddit'] = sub
+                        user_spill_writers[get_user_shard(index_link['author'])].writerow(index_link)
+            if len(batch) > 0:
+                media = {}
+                if not args.noimages:
+                    with stage('fetch_media'):
+                        media = fetch_media(batch, sub)
+                        # sign the pages with what they were rendered with
+                        for l in batch:
+                            set_page_signature(get_link_page_path(l), get_signature(subs, sub, l, get_media_state(l, sub)))
+                if pool is None:
+                    write_link_pages(subs, batch, sub, hide_deleted_comments, media)
+                else:
+                    # bound the number of queued days so memory stays flat
+                    pending_batches.append(pool.apply_async(write_link_pages, (subs, batch, sub, hide_deleted_comments, media)))
+                    while len(pending_batches) > jobs * 2:
+                        with stage('wait_workers'):
+                            merge_worker_result(pending_batches.pop(0).get())
+        if not owns_sub:
+            continue
         if stat_sub_filtered_links > 0:
             processed_subs.append({'name': sub, 'num_links': stat_sub_filtered_links})
         print('%s: %s links filtered to %s' % (sub, stat_sub_links, stat_sub_filtered_links))
 
         # write subreddit pages
-        valid_sub_links = []
-        d = start_date
-        while d <= end_date:
-            raw_links = load_links(d, sub)
-            for l in raw_links:
-                if validate_link(l, min_score, min_comments):
-                    valid_sub_links.append(l)
-
-                    # collect links for user pages
-                    # TODO: this is the least performant bit. load and generate user pages user by user instead.
-                    l['subreddit'] = sub
-                    if l['author'] not in user_index.keys():
-                        user_index[l['author']] = []
-                    user_index[l['author']].append(l)
-            d += delta
-        write_subreddit_pages(sub, subs, valid_sub_links, stat_sub_filtered_links, stat_sub_comments)
-        write_subreddit_search_page(sub, subs, valid_sub_links, stat_sub_filtered_links, stat_sub_comments)
-
-    # write user pages
-    write_user_page(processed_subs, user_index)
-
-    # write index page
-    write_index(processed_subs)
+        sub_signature = get_signature(subs, sub, stat_sub_comments, sub_hash.hexdigest())
+        sub_table = LinkTable.concat(sub_tables)
+        with stage('subreddit_pages'):
+            write_subreddit_pages(sub, subs, sub_table, stat_sub_filtered_links, stat_sub_comments, sub_signature)
+        with stage('search'):
+            write_subreddit_search_page(sub, subs, sub_table, stat_sub_filtered_links, stat_sub_comments, sub_signature)
+            write_search_index(sub, sub_table, search_spill)
+
+    stats_sub = ''
+    if pool is not None:
+        with stage('wait_workers'):
+            for result in pending_batches:
+                merge_worker_result(result.get())
+        pool.close()
+        pool.join()
+    close_media_executor()
+    commit_markdown_cache()
+
+    for file in user_spill_files:
+        file.close()
+    if shard_path is not None:
+        # user pages and the index page are left to --merge
+        save_shard_info(shard_path, subs, processed_subs)
+    elif args.sub != '-':
+        # they need every subreddit's links, --sub only has one
+        print('user pages and index page not updated with --sub, run without --sub to update them')
+        shutil.rmtree(user_spill_path)
+    else:
+        # write user pages
+        with stage('user_pages'):
+            write_user_pages(processed_subs, [user_spill_path])
+        shutil.rmtree(user_spill_path)
+
+        # write index page
+        with stage('index'):
+            write_index(processed_subs)
+
+    finish_output(jobs)
     print('all done. %s links filtered to %s' % (stat_links, stat_filtered_links))
 
-def write_subreddit_pages(subreddit, subs, link_index, stat_sub_filtered_links, stat_sub_comments):
-    if len(link_index) == 0:
+def finish_output(jobs=1):
+    if args.compress:
+        with stage('compress'):
+            compress_pages(jobs)
+
+    # every page has to be on disk or committed to the pack before the
+    # manifest says so, otherwise a failed write would never be retried
+    with stage('flush_output'):
+        flush_output()
+    if args.pack:
+        with stage('pack_static'):
+            pack_static_files()
+
+    # forget and delete pages that weren't produced this run
+    with stage('save_manifest'):
+        if args.sub == '-':
+            save_manifest()
+        else:
+            save_manifest('r/' + args.sub + '/')
+    print_progress(True)
+    write_report()
+    dump_profiles()
+
+# --shard i/N splits a run over machines. subreddits and links are assigned by
+# a hash of their name and id, so every machine agrees without coordination.
+# each shard writes its pages plus shards/<i>-of-<N>/ with its subreddits and
+# user page records, --merge then writes the user pages and the index page
+def get_shard_num(key, num_shards):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % num_shards + 1
+
+def owns_shard_key(key):
+    return args.shard is None or get_shard_num(key, args.shard[1]) == args.shard[0]
+
+def get_shard_path(shard_num, num_shards):
+    return shards_dir + '/%s-of-%s' % (shard_num, num_shards)
+
+def save_shard_info(shard_path, subs, processed_subs):
+    info = {'shard': args.shard[0], 'num_shards': args.shard[1], 'subs': subs, 'processed_subs': processed_subs}
+    with open(shard_path + '/subs.json.tmp', 'w', encoding='utf-8') as file:
+        json.dump(info, file)
+    os.replace(shard_path + '/subs.json.tmp', shard_path + '/subs.json')
+
+def load_shard_infos():
+    infos = {}
+    if os.path.isdir(shards_dir):
+        for name in sorted(os.listdir(shards_dir)):
+            info_path = shards_dir + '/' + name + '/subs.json'
+            if os.path.isfile(info_path):
+                with open(info_path, 'r', encoding='utf-8') as file:
+                    info = json.load(file)
+                info['path'] = shards_dir + '/' + name
+                infos.setdefault(info['num_shards'], {})[info['shard']] = info
+    if len(infos) != 1:
+        print('ERROR: expected the output of one --shard i/N run per shard in %s, found %s shard counts' % (shards_dir, len(infos)))
+        return None
+    num_shards, shard_infos = list(infos.items())[0]
+    missing = [str(i) for i in range(1, num_shards + 1) if i not in shard_infos]
+    if len(missing) > 0:
+        print('ERROR: missing shards %s of %s' % (', '.join(missing), num_shards))
+        return None
+    return [shard_infos[i] for i in range(1, num_shards + 1)]
+
+def merge_shards(jobs=1):
+    global stats_started
+    stats_started = time.time()
+    shard_infos = load_shard_infos()
+    if shard_infos is None:
+        return False
+    load_manifest()
+    print('merging %s shards' % len(shard_infos))
+
+    # subreddits in the order one run would have processed them
+    processed = {}
+    for info in shard_infos:
+        for sub in info['processed_subs']:
+            processed[sub['name']] = sub
+    processed_subs = [processed[sub] for sub in shard_infos[0]['subs'] if sub in processed]
+
+    with stage('user_pages'):
+        write_user_pages(processed_subs, [info['path'] + '/users' for info in shard_infos])
+    with stage('index'):
+        write_index(processed_subs)
+
+    finish_output(jobs)
+    print('all done. merged %s subreddits' % len(processed_subs))
+    return True
+
+def write_subreddit_pages(subreddit, subs, link_table, stat_sub_filtered_links, stat_sub_comments, signature=None):
+    if len(link_table) == 0:
         return True
 
     for sort in sort_indexes.keys():
-        links = sorted(link_index, key=lambda k: (int(k[sort]) if k[sort] != '' else sort_indexes[sort]['default']), reverse=True)
-        pages = list(chunks(links, links_per_page))
+        # pages are slices of the sorted row indexes
+        order = link_table.sort_order(sort, sort_indexes[sort]['default'])
+        pages = list(chunks(order, links_per_page))
         page_num = 0
 
         sort_based_prefix = '../'
@@ -234,17 +1054,27 @@ def write_subreddit_pages(subreddit, subs, link_index, stat_sub_filtered_links,
         subs_menu_html = ''
         for sub in subs:
             sub_url = sort_based_prefix + '../' + sub + '/index.html'
-            subs_menu_html += template_sub_link.replace('###URL_SUB###', sub_url).replace('###SUB###', sub)
+            subs_menu_html += render_template(template_sub_link, {'###URL_SUB###': sub_url, '###SUB###': sub})
 
         for page in pages:
             page_num += 1
             # print('%s page' % (page))
 
+            suffix = '-' + str(page_num) + '.html'
+            if page_num == 1:
+                suffix = '.html'
+            filename = 'index' + suffix
+            if sort == default_sort:
+                filepath = 'r/' + subreddit + '/' + filename
+            else:
+                filepath = 'r/' + subreddit + '/index-' + sort_indexes[sort]['slug'] + '/' + filename
+            if page_is_current(filepath, signature):
+                continue
+
             links_html = ''
-            for l in page:
-                author_link_html = template_user_url
-                author_url = sort_based_prefix + '../user/' + l['author'] + '.html'
-                author_link_html = author_link_html.replace('###URL_AUTHOR###', author_url).replace('###AUTHOR###', l['author'])
+            for l in link_table.rows(page):
+                author_url = sort_based_prefix + '../' + get_user_url(l['author'])
+                author_link_html = render_template(template_user_url, {'###URL_AUTHOR###': author_url, '###AUTHOR###': l['author']})
 
                 link_url = l['url']
                 link_comments_url = sort_based_prefix + l['permalink'].lower().strip('/')
@@ -265,9 +1095,7 @@ def write_subreddit_pages(subreddit, subs, link_index, stat_sub_filtered_links,
                     '###LINK_DOMAIN###':        '(self.' + subreddit + ')' if l['is_self'] is True or l['is_self'] == 'True' else '',
                     '###HTML_AUTHOR_URL###':    author_link_html,
                 }
-                link_html = template_link_url
-                for key, value in index_link_data_map.items():
-                    link_html = link_html.replace(key, value)
+                link_html = render_template(template_link_url, index_link_data_map)
                 links_html += link_html + '\n'
 
             index_page_data_map = {
@@ -290,37 +1118,96 @@ def write_subreddit_pages(subreddit, subs, link_index, stat_sub_filtered_links,
                 '###HTML_SUBS_MENU###':         subs_menu_html,
                 '###HTML_PAGER###':             get_pager_html(page_num, len(pages)),
             }
-            page_html = template_subreddit
-            for key, value in index_page_data_map.items():
-                page_html = page_html.replace(key, value)
+            page_html = render_template(template_subreddit, index_page_data_map)
 
-            
             # write file
-            suffix = '-' + str(page_num) + '.html'
-            if page_num == 1:
-                suffix = '.html'
-            filename = 'index' + suffix
-            if sort == default_sort:
-                filepath = 'r/' + subreddit + '/' + filename
-            else:
-                filepath = 'r/' + subreddit + '/index-' + sort_indexes[sort]['slug'] + '/' + filename
-            if not os.path.isfile(filepath):
-                os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                with open(filepath, 'w', encoding='utf-8') as file:
-                    file.write(page_html)
-                    # print('wrote %s %s, %s links' % (sort, filepath, len(page)))
+            write_page(filepath, page_html)
+            # print('wrote %s %s, %s links' % (sort, filepath, len(page)))
 
     return True
 
-def write_link_page(subreddits, link, subreddit='', hide_deleted_comments=False):
+def init_worker(worker_args):
+    global args, deferred_output, stats, profiles
+    args = worker_args
+    deferred_output = []
+    stats = {}
+    profiles = {}
+
+def write_link_pages(subreddits, links, subreddit='', hide_deleted_comments=False, media={}):
+    global deferred_output, stats, stats_sub
+    stats_sub = subreddit
+    with stage('link_pages'):
+        for l in links:
+            write_link_page(subreddits, l, subreddit, hide_deleted_comments, media.get(l['id']))
+        commit_markdown_cache()
+    # in a worker, pages for the parent to write to the pack and the counters
+    if deferred_output is None:
+        return None
+    with stage('flush_output'):
+        flush_output()
+    result = (subreddit, deferred_output, stats)
+    deferred_output = []
+    stats = {}
+    dump_profiles('-%s' % os.getpid())
+    return result
+
+def get_link_page_path(link):
     # reddit:  https://www.reddit.com/r/conspiracy/comments/8742iv/happening_now_classmate_former_friend_of/
     # archive: r/conspiracy/comments/8/7/4/2/i/v/happening_now_classmate_former_friend_of.html
     idpath = '/'.join(list(link['id']))
     filepath = link['permalink'].lower().strip('/') + '.html'
-    filepath = filepath.replace(link['id'], idpath)
-    if os.path.isfile(filepath):
-        return True
-
+    return filepath.replace(link['id'], idpath)
+
+# identical bodies like [deleted] are rendered once per process. with
+# --markdown-cache rendered html is also kept in a sqlite file shared by the
+# worker processes and later runs, keyed by a hash of the markdown
+@functools.lru_cache(maxsize=markdown_cache_size)
+def render_markdown(text):
+    start = time.perf_counter()
+    html = render_markdown_uncached(text)
+    count_stat('markdown_renders')
+    count_stat('markdown_seconds', time.perf_counter() - start)
+    return html
+
+def render_markdown_uncached(text):
+    db = get_markdown_cache()
+    if db is None:
+        return snudown.markdown(text)
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    row = db.execute('SELECT html FROM markdown WHERE key = ?', (key,)).fetchone()
+    if row is not None:
+        return row[0]
+    html = snudown.markdown(text)
+    db.execute('INSERT OR REPLACE INTO markdown (key, html) VALUES (?, ?)', (key, html))
+    markdown_cache['pending'] += 1
+    if markdown_cache['pending'] >= markdown_cache_commit_every:
+        commit_markdown_cache()
+    return html
+
+# connections are not shared with forked workers, each process opens its own
+markdown_cache = {}
+def get_markdown_cache():
+    if not args.markdown_cache:
+        return None
+    if markdown_cache.get('pid') != os.getpid():
+        os.makedirs(cache_dir, exist_ok=True)
+        db = sqlite3.connect(markdown_cache_file, timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS markdown (key TEXT PRIMARY KEY, html TEXT)')
+        db.commit()
+        markdown_cache['db'] = db
+        markdown_cache['pid'] = os.getpid()
+        markdown_cache['pending'] = 0
+    return markdown_cache['db']
+
+def commit_markdown_cache():
+    if markdown_cache.get('pid') == os.getpid() and markdown_cache['pending'] > 0:
+        markdown_cache['db'].commit()
+        markdown_cache['pending'] = 0
+
+# callers decide whether the page is stale, see page_is_current(), and download
+# media first, see fetch_media()
+def write_link_page(subreddits, link, subreddit='', hide_deleted_comments=False, media_path=None):
     created = datetime.utcfromtimestamp(int(link['created_utc']))
     sorted_comments = []
     if len(link['comments']) > 0:
@@ -331,25 +1218,11 @@ def write_link_page(subreddits, link, subreddit='', hide_deleted_comments=False)
     for i in range(len(link['id']) + 2):
         static_include_path += '../'
 
-    image = None
-    if not args.noimages:
-        i = is_imgur(link['url'])
-        # if we have an imgur client id and the url in the loop is an imgur link then get the URL
-        if i[0]:
-            # Extract url from json and download the image itself
-            imu = get_imgur_image_link(link['url']) 
-            if imu is not None:
-                image = retrieve_media(imu)
-        elif i[1]:
-            # TODO: Implement Imgur albums support 
-            pass
-        else:
-            image = retrieve_media(link['url'])
-        # Finally, if the image is downloaded then generate a path and attach it to the url entry in the link dict
-        # so when it's used as an href link it will point to the path instead of the url itself
-        # URL + /images/ + ID + . Image Extension
-        if image is not None: link['url'] = subreddit + "/images/" + link['id'] + "." + image[0]
-        
+    # if the image was downloaded attach its path to the url entry in the link dict
+    # so when it's used as an href link it will point to the path instead of the url itself
+    if media_path is not None:
+        link['url'] = media_path
+
     # render comments
     comments_html = ''
     for c in sorted_comments:
@@ -360,8 +1233,8 @@ def write_link_page(subreddits, link, subreddit='', hide_deleted_comments=False)
             css_classes += ' stickied'
 
         # author link
-        url = static_include_path + 'user/' + c['author'] + '.html'
-        author_link_html = template_user_url.replace('###URL_AUTHOR###', url).replace('###AUTHOR###', c['author'])
+        url = static_include_path + get_user_url(c['author'])
+        author_link_html = render_template(template_user_url, {'###URL_AUTHOR###': url, '###AUTHOR###': c['author']})
 
         comment_data_map = {
             '###ID###':                 c['id'],
@@ -369,36 +1242,34 @@ def write_link_page(subreddits, link, subreddit='', hide_deleted_comments=False)
             '###DEPTH###':              str(c['depth']),
             '###DATE###':               created.strftime('%Y-%m-%d'),
             '###SCORE###':              str(c['score']) if len(str(c['score'])) > 0 else missing_comment_score_label,
-            '###BODY###':               snudown.markdown(c['body'].replace('&gt;','>')),
+            '###BODY###':               render_markdown(c['body'].replace('&gt;','>')),
             '###CSS_CLASSES###':        css_classes,
             '###CLASS_SCORE###':        'badge-danger' if len(c['score']) > 0 and int(c['score']) < 1 else 'badge-secondary',
             '###HTML_AUTHOR_URL###':    author_link_html,
         }
-        comment_html = template_comment
-        for key, value in comment_data_map.items():
-            comment_html = comment_html.replace(key, value)
+        comment_html = render_template(template_comment, comment_data_map)
         comments_html += comment_html + '\n'
 
     # render subreddits list
     subs_menu_html = ''
     for sub in subreddits:
         sub_url = static_include_path + sub + '/index.html'
-        subs_menu_html += template_sub_link.replace('###URL_SUB###', sub_url).replace('###SUB###', sub)
+        subs_menu_html += render_template(template_sub_link, {'###URL_SUB###': sub_url, '###SUB###': sub})
 
     # render selftext
     selftext_html = ''
     if len(link['selftext']) > 0:
-        selftext_html = template_selftext.replace('###SELFTEXT###', snudown.markdown(link['selftext'].replace('&gt;','>')))
+        selftext_html = render_template(template_selftext, {'###SELFTEXT###': render_markdown(link['selftext'].replace('&gt;','>'))})
 
     # author link
-    url = static_include_path + 'user/' + link['author'] + '.html'
-    author_link_html = template_user_url.replace('###URL_AUTHOR###', url).replace('###AUTHOR###', link['author'])
+    url = static_include_path + get_user_url(link['author'])
+    author_link_html = render_template(template_user_url, {'###URL_AUTHOR###': url, '###AUTHOR###': link['author']})
 
     #html_title = template_url.replace('#HREF#', link['url']).replace('#INNER_HTML#', link['title'])
-    if image is None:
-        html_title = template_url.replace('#HREF#', link['url']).replace('#INNER_HTML#', link['title'])
+    if media_path is None:
+        html_title = render_template(template_url, {'#HREF#': link['url'], '#INNER_HTML#': link['title']})
     else:
-        html_title = template_url.replace('#HREF#', static_include_path + link['url']).replace('#INNER_HTML#', link['title'])
+        html_title = render_template(template_url, {'#HREF#': static_include_path + link['url'], '#INNER_HTML#': link['title']})
     if link['is_self'] is True or link['is_self'].lower() == 'true':
         html_title = link['title']
 
@@ -424,58 +1295,31 @@ def write_link_page(subreddits, link, subreddit='', hide_deleted_comments=False)
         '###HTML_AUTHOR_URL###':    author_link_html,
         '###HTML_TITLE###':         html_title,
     }
-    html = template_link
-    for key, value in link_data_map.items():
-        html = html.replace(key, value)
+    html = render_template(template_link, link_data_map)
 
     # write html
-    # reddit:  https://www.reddit.com/r/conspiracy/comments/8742iv/happening_now_classmate_former_friend_of/
-    # archive: r/conspiracy/comments/8/7/4/2/i/v/happening_now_classmate_former_friend_of.html
-    idpath = '/'.join(list(link['id']))
-    filepath = link['permalink'].lower().strip('/') + '.html'
-    filepath = filepath.replace(link['id'], idpath)
-    if not os.path.isfile(filepath):
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as file:
-            file.write(html)
-        # print('wrote %s %s' % (created.strftime('%Y-%m-%d'), filepath))
-        
-    if image is not None:
-        if not os.path.isfile(link['url']):
-            os.makedirs("r/" + subreddit + "/images/", exist_ok=True)
-            open("r/" + link['url'], 'wb').write(image[1])
-            print("Writing media: %s " % link['url'])
+    filepath = get_link_page_path(link)
+    write_page(filepath, html)
+    # print('wrote %s %s' % (created.strftime('%Y-%m-%d'), filepath))
+
+    if media_path is not None:
         # Add a '../' because we will reuse the file location for the index file
         link['url'] = "../" + link['url']
     return True
 
-def write_subreddit_search_page(subreddit, subs, link_index, stat_sub_filtered_links, stat_sub_comments):
-    if len(link_index) == 0:
+def write_subreddit_search_page(subreddit, subs, link_table, stat_sub_filtered_links, stat_sub_comments, signature=None):
+    if len(link_table) == 0:
         return True
 
-    # name sort?
-    links = sorted(link_index, key=lambda k: re.sub(r'\W+', '', k['title']).lower())
+    filepath = 'r/' + subreddit + '/search.html'
+    if page_is_current(filepath, signature):
+        return True
 
     # render subreddits list
     subs_menu_html = ''
     for sub in subs:
         sub_url = '../' + sub + '/index.html'
-        subs_menu_html += template_sub_link.replace('###URL_SUB###', sub_url).replace('###SUB###', sub)
-
-    links_html = ''
-    for l in links:
-        link_comments_url = l['permalink'].lower().strip('/').replace('r/' + subreddit + '/', '')
-        idpath = '/'.join(list(l['id']))
-        link_comments_url = link_comments_url.replace(l['id'], idpath)
-        link_comments_url += '.html'
-        index_link_data_map = {
-            '###TITLE###':              l['title'],
-            '###URL###':                link_comments_url,
-        }
-        link_html = template_search_link
-        for key, value in index_link_data_map.items():
-            link_html = link_html.replace(key, value)
-        links_html += link_html + '\n'
+        subs_menu_html += render_template(template_sub_link, {'###URL_SUB###': sub_url, '###SUB###': sub})
 
     index_page_data_map = {
         '###INCLUDE_PATH###':           '../',
@@ -493,91 +1337,307 @@ def write_subreddit_search_page(subreddit, subs, link_index, stat_sub_filtered_l
         '###URL_IDX_CMNT_CSS###':       '',
         '###URL_IDX_DATE_CSS###':       '',
         '###URL_SEARCH_CSS###':         'active',
-        '###HTML_LINKS###':             links_html,
+        '###SEARCH_DOCS_PER_SHARD###':  str(search_docs_per_shard),
         '###HTML_SUBS_MENU###':         subs_menu_html,
     }
-    page_html = template_search
-    for key, value in index_page_data_map.items():
-        page_html = page_html.replace(key, value)
+    page_html = render_template(template_search, index_page_data_map)
 
     # write file
-    filename = 'search.html'
-    filepath = 'r/' + subreddit + '/' + filename
-    if not os.path.isfile(filepath):
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as file:
-            file.write(page_html)
-            # print('wrote %s, %s links' % (filepath, len(links)))
+    write_page(filepath, page_html)
+    # print('wrote %s, %s links' % (filepath, len(links)))
     return True
 
-def write_user_page(subs, user_index):
+# search.html runs on an inverted index of titles, selftexts and comments in
+# r/<sub>/search: t/<term prefix>.js map terms to doc ids, d/<n>.js hold the
+# docs. the browser only loads the shards a query needs, as scripts so that
+# it works from file:// too. doc ids are the link's row in the subreddit table
+def get_search_terms(link):
+    texts = [link['title'], link.get('selftext', '')]
+    for c in link.get('comments', []):
+        if c['body'] not in removed_content_identifiers:
+            texts.append(c['body'])
+    terms = set()
+    for text in texts:
+        for term in search_term.findall(text.lower()):
+            if search_min_term_length <= len(term) <= search_max_term_length:
+                terms.add(term)
+    return terms
+
+def get_search_shard_name(term, length=search_prefix_length):
+    name = ''
+    for c in term[:length]:
+        if c in search_shard_chars:
+            name += c
+        else:
+            name += '_%x_' % ord(c)
+    return name
+
+# postings are appended to one spill file per shard as 'term<tab>doc id' lines
+# in doc order, so only a shard at a time is held in memory when it's written
+def open_search_spill():
+    os.makedirs(cache_dir, exist_ok=True)
+    return {'path': tempfile.mkdtemp(prefix='search-', dir=cache_dir), 'buffer': {}, 'postings': 0, 'docs': 0}
+
+def add_search_terms(search_spill, doc_id, link):
+    for term in get_search_terms(link):
+        search_spill['buffer'].setdefault(get_search_shard_name(term), []).append('%s\t%s\n' % (term, doc_id))
+        search_spill['postings'] += 1
+    search_spill['docs'] = doc_id + 1
+    if search_spill['postings'] >= search_spill_postings:
+        flush_search_spill(search_spill['path'], search_spill['buffer'])
+        search_spill['postings'] = 0
+
+def flush_search_spill(path, buffer):
+    for name, lines in buffer.items():
+        with open(path + '/' + name, 'a', encoding='utf-8') as file:
+            file.writelines(lines)
+    buffer.clear()
+
+# t/<prefix>.js map terms to doc ids. shards over search_shard_max_bytes are
+# split into shards of one character longer prefixes, terms no longer than the
+# prefix stay in the split shard. index.js lists the split shards and the
+# stopwords for the browser
+def write_search_index(subreddit, link_table, search_spill):
+    flush_search_spill(search_spill['path'], search_spill['buffer'])
+    index = {'splits': [], 'stopwords': []}
+    for name in sorted(os.listdir(search_spill['path'])):
+        spill_file = search_spill['path'] + '/' + name
+        stopwords = get_search_stopwords(spill_file, search_spill['docs'])
+        index['stopwords'] += stopwords
+        write_search_prefix(subreddit, spill_file, name, search_prefix_length, set(stopwords), index)
+    shutil.rmtree(search_spill['path'])
+    index['splits'].sort()
+    index['stopwords'].sort()
+    js = 'archiveSearchIndex(%s);\n' % json.dumps(index, separators=(',', ':'))
+    write_search_shard('r/' + subreddit + '/search/index.js', js)
+
+    for shard_num, start in enumerate(range(0, len(link_table), search_docs_per_shard)):
+        docs = []
+        for l in link_table.rows(range(start, min(start + search_docs_per_shard, len(link_table)))):
+            link_comments_url = l['permalink'].lower().strip('/').replace('r/' + subreddit + '/', '')
+            idpath = '/'.join(list(l['id']))
+            link_comments_url = link_comments_url.replace(l['id'], idpath)
+            link_comments_url += '.html'
+            docs.append([l['title'], link_comments_url])
+        js = 'archiveSearchDocs(%s, %s);\n' % (shard_num, json.dumps(docs, separators=(',', ':')))
+        write_search_shard('r/' + subreddit + '/search/d/' + str(shard_num) + '.js', js)
+
+# terms in most posts of a large subreddit would make shards as big as the
+# subreddit and don't narrow a search down anyway
+def get_search_stopwords(spill_file, num_docs):
+    if num_docs < search_stopword_min_docs:
+        return []
+    counts = {}
+    with open(spill_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            term = line[:line.index('\t')]
+            counts[term] = counts.get(term, 0) + 1
+    return [term for term, count in counts.items() if count > num_docs * search_stopword_ratio]
+
+def write_search_prefix(subreddit, spill_file, name, length, stopwords, index):
+    if os.path.getsize(spill_file) <= search_shard_max_bytes or length >= search_max_prefix_length:
+        write_search_terms(subreddit, spill_file, name, stopwords)
+        return
+    index['splits'].append(name)
+    # '_base' can't be a shard name, '_' only starts an encoded character
+    split_path = spill_file + '.split'
+    os.makedirs(split_path)
+    buffer = {}
+    buffered = 0
+    with open(spill_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            term = line[:line.index('\t')]
+            if term in stopwords:
+                continue
+            child = '_base' if len(term) <= length else get_search_shard_name(term, length + 1)
+            buffer.setdefault(child, []).append(line)
+            buffered += 1
+            if buffered >= search_spill_postings:
+                flush_search_spill(split_path, buffer)
+                buffered = 0
+    flush_search_spill(split_path, buffer)
+    os.remove(spill_file)
+    for child in sorted(os.listdir(split_path)):
+        if child == '_base':
+            write_search_terms(subreddit, split_path + '/' + child, name, stopwords)
+        else:
+            write_search_prefix(subreddit, split_path + '/' + child, child, length + 1, stopwords, index)
+    shutil.rmtree(split_path)
+
+def write_search_terms(subreddit, spill_file, name, stopwords):
+    terms = {}
+    with open(spill_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            term, doc_id = line.rstrip('\n').split('\t')
+            if term not in stopwords:
+                terms.setdefault(term, []).append(int(doc_id))
+    if len(terms) == 0:
+        return
+    # doc ids are stored as deltas to the previous id
+    shard = {}
+    for term in sorted(terms.keys()):
+        doc_ids = terms[term]
+        shard[term] = [doc_ids[0]] + [doc_ids[i] - doc_ids[i - 1] for i in range(1, len(doc_ids))]
+    js = 'archiveSearchTerms(%s, %s);\n' % (json.dumps(name), json.dumps(shard, separators=(',', ':')))
+    write_search_shard('r/' + subreddit + '/search/t/' + name + '.js', js)
+
+# shards are only rewritten when their content changed
+def write_search_shard(filepath, js):
+    if not page_is_current(filepath, hashlib.sha1(js.encode('utf-8')).hexdigest()):
+        write_page(filepath, js)
+
+# path is kept for --merge when given, a temporary directory otherwise
+def open_user_spill(path=None):
+    if path is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = tempfile.mkdtemp(prefix='users-', dir=cache_dir)
+    else:
+        os.makedirs(path, exist_ok=True)
+    files = []
+    writers = []
+    for shard in range(user_shards):
+        file = open(path + '/' + str(shard) + '.csv', 'w', encoding='utf-8', newline='')
+        writer = csv.DictWriter(file, fieldnames=user_link_fields, extrasaction='ignore')
+        writer.writeheader()
+        files.append(file)
+        writers.append(writer)
+    return path, files, writers
+
+def get_user_shard(author):
+    return int(hashlib.md5(author.encode('utf-8')).hexdigest()[:8], 16) % user_shards
+
+# only one shard of authors is held in memory at a time. with --merge the
+# shard is read from every --shard spill, in subreddit order like one run
+def write_user_pages(subs, spill_paths):
+    sub_order = dict((sub['name'], i) for i, sub in enumerate(subs))
+    for shard in range(user_shards):
+        write_user_shard(subs, sub_order, [spill_path + '/' + str(shard) + '.csv' for spill_path in spill_paths])
+
+# a shard over user_shard_max_bytes is streamed into smaller ones by the next
+# 8 digits of the author hash, so memory doesn't grow with the archive
+def write_user_shard(subs, sub_order, spill_files, depth=1):
+    if depth < 4 and sum(os.path.getsize(f) for f in spill_files) > user_shard_max_bytes:
+        split_path = tempfile.mkdtemp(prefix='users-split-', dir=cache_dir)
+        split_files = [[] for split in range(user_shard_splits)]
+        # one input shard at a time, so open files don't grow with --shard N
+        for i, spill_file in enumerate(spill_files):
+            split_names = [split_path + '/' + str(split) + '-' + str(i) + '.csv' for split in range(user_shard_splits)]
+            for split in range(user_shard_splits):
+                split_files[split].append(split_names[split])
+            for first in range(0, user_shard_splits, user_split_open_files):
+                split_user_shard(spill_file, split_names, range(first, min(first + user_split_open_files, user_shard_splits)), depth)
+        for split in range(user_shard_splits):
+            write_user_shard(subs, sub_order, split_files[split], depth + 1)
+        shutil.rmtree(split_path)
+        return
+    links = []
+    for spill_file in spill_files:
+        with open(spill_file, 'r', encoding='utf-8', newline='') as file:
+            links += list(csv.DictReader(file))
+    if len(spill_files) > 1:
+        links.sort(key=lambda l: sub_order.get(l['subreddit'], len(sub_order)))
+    link_table = LinkTable.from_links(links, user_link_fields)
+    # author -> row indexes
+    user_index = {}
+    for i, author in enumerate(link_table.column('author')):
+        if author not in user_index:
+            user_index[author] = []
+        user_index[author].append(i)
+    write_user_page(subs, link_table, user_index)
+
+# writes the links of spill_file that fall into the given splits
+def split_user_shard(spill_file, split_names, splits, depth):
+    with contextlib.ExitStack() as stack:
+        writers = {}
+        for split in splits:
+            file = stack.enter_context(open(split_names[split], 'w', encoding='utf-8', newline=''))
+            writers[split] = csv.DictWriter(file, fieldnames=user_link_fields, extrasaction='ignore')
+            writers[split].writeheader()
+        file = stack.enter_context(open(spill_file, 'r', encoding='utf-8', newline=''))
+        for l in csv.DictReader(file):
+            digest = hashlib.md5(l['author'].encode('utf-8')).hexdigest()
+            split = int(digest[depth * 8:depth * 8 + 8], 16) % user_shard_splits
+            if split in writers:
+                writers[split].writerow(l)
+
+# user pages are spread over 256 directories by author hash and paginated.
+# usernames can't contain dots, pages after the first are <author>.<n>.html
+def get_user_url(author, page_num=1):
+    url = 'user/' + hashlib.md5(author.encode('utf-8')).hexdigest()[:2] + '/' + author
+    if page_num > 1:
+        url += '.' + str(page_num)
+    return url + '.html'
+
+def write_user_page(subs, link_table, user_index):
     if len(user_index.keys()) == 0:
         return False
 
     # subreddits list
     subs_menu_html = ''
     for sub in subs:
-        sub_url = '../' + sub['name'] + '/index.html'
-        subs_menu_html += template_sub_link.replace('###URL_SUB###', sub_url).replace('###SUB###', sub['name'])
+        sub_url = '../../' + sub['name'] + '/index.html'
+        subs_menu_html += render_template(template_sub_link, {'###URL_SUB###': sub_url, '###SUB###': sub['name']})
 
     for user in user_index.keys():
-        links = user_index[user]
-        links.sort(key=lambda k: (int(k['score']) if k['score'] != '' else sort_indexes['score']['default']), reverse=True)
+        links = link_table.take(user_index[user])
+        # the menu only shows names, num_links would rebuild every user page for each new link
+        signature = get_signature([sub['name'] for sub in subs], list(links.rows()))
+        pages = list(chunks(links.sort_order('score', sort_indexes['score']['default']), links_per_page))
+        page_num = 0
+        for page in pages:
+            page_num += 1
+            filepath = 'r/' + get_user_url(user, page_num)
+            if page_is_current(filepath, signature):
+                continue
+            write_user_page_file(subs_menu_html, user, links, page, page_num, len(pages), filepath)
 
-        links_html = ''
-        for l in links:
+    return True
+
+def write_user_page_file(subs_menu_html, user, links, page, page_num, num_pages, filepath):
+    links_html = ''
+    for l in links.rows(page):
 
-            author_link_html = template_user_url
-            author_url = l['author'] + '.html'
-            author_link_html = author_link_html.replace('###URL_AUTHOR###', author_url).replace('###AUTHOR###', l['author'])
+        author_url = l['author'] + '.html'
+        author_link_html = render_template(template_user_url, {'###URL_AUTHOR###': author_url, '###AUTHOR###': l['author']})
 
-            link_comments_url = l['permalink'].lower().replace('/r/', '').strip('/')
-            link_comments_url = '../' + link_comments_url
-            idpath = '/'.join(list(l['id']))
-            link_comments_url = link_comments_url.replace(l['id'], idpath)
-            link_comments_url += '.html'
-            link_url = l['url']
-            if l['is_self'] is True or l['is_self'] == 'True':
-                link_url = link_comments_url
-
-            link_data_map = {
-                '###TITLE###':              l['title'],
-                '###URL###':                link_url,
-                '###URL_COMMENTS###':       link_comments_url,
-                '###SCORE###':              str(l['score']),
-                '###NUM_COMMENTS###':       str(l['num_comments']) if int(l['num_comments']) > 0 else str(0),
-                '###DATE###':               datetime.utcfromtimestamp(int(l['created_utc'])).strftime('%Y-%m-%d'),
-                '###SUB###':                l['subreddit'],
-                '###SUB_URL###':            '../' + l['subreddit'] + '/index.html',
-                '###HTML_AUTHOR_URL###':    author_link_html,
-            }
-            link_html = template_user_page_link
-            for key, value in link_data_map.items():
-                link_html = link_html.replace(key, value)
-            links_html += link_html + '\n'
-
-        page_data_map = {
-            '###INCLUDE_PATH###':           '../',
-            '###TITLE###':                  'user/' + user,
-            '###ARCH_NUM_POSTS###':         str(len(links)),
-            '###URL_USER###':               user + '.html',
-            '###URL_SUBS###':               '../index.html',
-            '###URL_PROJECT###':            url_project,
-            '###HTML_LINKS###':             links_html,
-            '###HTML_SUBS_MENU###':         subs_menu_html,
+        link_comments_url = l['permalink'].lower().replace('/r/', '').strip('/')
+        link_comments_url = '../../' + link_comments_url
+        idpath = '/'.join(list(l['id']))
+        link_comments_url = link_comments_url.replace(l['id'], idpath)
+        link_comments_url += '.html'
+        link_url = l['url']
+        if l['is_self'] is True or l['is_self'] == 'True':
+            link_url = link_comments_url
+
+        link_data_map = {
+            '###TITLE###':              l['title'],
+            '###URL###':                link_url,
+            '###URL_COMMENTS###':       link_comments_url,
+            '###SCORE###':              str(l['score']),
+            '###NUM_COMMENTS###':       str(l['num_comments']) if int(l['num_comments']) > 0 else str(0),
+            '###DATE###':               datetime.utcfromtimestamp(int(l['created_utc'])).strftime('%Y-%m-%d'),
+            '###SUB###':                l['subreddit'],
+            '###SUB_URL###':            '../../' + l['subreddit'] + '/index.html',
+            '###HTML_AUTHOR_URL###':    author_link_html,
         }
-        page_html = template_user
-        for key, value in page_data_map.items():
-            page_html = page_html.replace(key, value)
+        link_html = render_template(template_user_page_link, link_data_map)
+        links_html += link_html + '\n'
 
-        filepath = 'r/user/' + user + '.html'
-        if not os.path.isfile(filepath):
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            with open(filepath, 'w', encoding='utf-8') as file:
-                file.write(page_html)
-            # print('wrote %s' % (filepath))
+    page_data_map = {
+        '###INCLUDE_PATH###':           '../../',
+        '###TITLE###':                  'user/' + user,
+        '###ARCH_NUM_POSTS###':         str(len(links)),
+        '###URL_USER###':               user + '.html',
+        '###URL_SUBS###':               '../../index.html',
+        '###URL_PROJECT###':            url_project,
+        '###HTML_LINKS###':             links_html,
+        '###HTML_SUBS_MENU###':         subs_menu_html,
+        '###HTML_PAGER###':             get_pager_html(page_num, num_pages, user, '.'),
+    }
+    page_html = render_template(template_user, page_data_map)
 
-    return True
+    write_page(filepath, page_html)
+    # print('wrote %s' % (filepath))
 
 def write_index(subs):
     """global isubs
@@ -585,14 +1645,18 @@ def write_index(subs):
     if len(isubs) == 0 or args.index == None:
         isubs = [ k["sub"] for k,v in subs]"""
     subs.sort(key=lambda k: k['name'].casefold())
-    
+
+    filepath = 'r/index.html'
+    if page_is_current(filepath, get_signature(subs)):
+        return True
+
     stat_num_links = 0
     links_html = ''
     subs_menu_html = ''
     for sub in subs:
         sub_url = sub['name'] + '/index.html'
-        links_html += template_index_sub.replace('#URL_SUB#', sub_url).replace('#SUB#', sub['name']).replace('#NUM_LINKS#', str(sub['num_links']))
-        subs_menu_html += template_sub_link.replace('###URL_SUB###', sub_url).replace('###SUB###', sub['name'])
+        links_html += render_template(template_index_sub, {'#URL_SUB#': sub_url, '#SUB#': sub['name'], '#NUM_LINKS#': str(sub['num_links'])})
+        subs_menu_html += render_template(template_sub_link, {'###URL_SUB###': sub_url, '###SUB###': sub['name']})
         stat_num_links += sub['num_links']
 
     index_page_data_map = {
@@ -604,16 +1668,10 @@ def write_index(subs):
         '###HTML_LINKS###':             links_html,
         '###HTML_SUBS_MENU###':         subs_menu_html,
     }
-    page_html = template_index
-    for key, value in index_page_data_map.items():
-        page_html = page_html.replace(key, value)
+    page_html = render_template(template_index, index_page_data_map)
 
-    filepath = 'r/index.html'
-    if not os.path.isfile(filepath):
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as file:
-            file.write(page_html)
-        # print('wrote %s' % (filepath))
+    write_page(filepath, page_html)
+    # print('wrote %s' % (filepath))
 
     return True
 
@@ -653,21 +1711,28 @@ def sort_comments(comments, hide_deleted_comments=False):
         top_level_comments = sorted(top_level_comments, key=lambda k: (int(k['score']) if k['score'] != '' else 1), reverse=True)
         sorted_comments += top_level_comments
 
+    # index each comment's children once instead of scanning parent_map per comment
+    child_map = {}
+    for key, value in parent_map.items():
+        if value not in child_map:
+            child_map[value] = []
+        child_map[value].append(id_map[key])
+
     # add each top level comment's child comments
     sorted_linear_comments = []
     for c in sorted_comments:
         # only remove deleted comments if no children
-        if hide_deleted_comments and c['body'] in removed_content_identifiers and 't1_' + c['id'] not in parent_map.values():
+        if hide_deleted_comments and c['body'] in removed_content_identifiers and 't1_' + c['id'] not in child_map:
             pass
         else:
             sorted_linear_comments.append(c)
-            child_comments = get_comment_tree_list([], depth + 1, c, id_map, parent_map, hide_deleted_comments)
+            child_comments = get_comment_tree_list(depth + 1, c, child_map, hide_deleted_comments)
             if len(child_comments) > 0:
                 sorted_linear_comments += child_comments
 
     # add orphaned comments
     for c in comments:
-        if c['parent_id'] != link_id and c['parent_id'].replace('t1_', '') not in id_map.keys():
+        if c['parent_id'] != link_id and c['parent_id'].replace('t1_', '') not in id_map:
             if hide_deleted_comments and c['body'] in removed_content_identifiers:
                 continue
             sorted_linear_comments.append(c)
@@ -675,48 +1740,42 @@ def sort_comments(comments, hide_deleted_comments=False):
     # print('sort_comments() in %s out %s show deleted: %s' % (len(comments), len(sorted_comments), hide_deleted_comments))
     return sorted_linear_comments
 
-def get_comment_tree_list(tree, depth, parent_comment, id_map, parent_map, hide_deleted_comments):
-    parent_id = 't1_' + parent_comment['id']
+def get_child_comments(parent_comment, child_map, hide_deleted_comments):
     child_comments = []
-    for key, value in parent_map.items():
-        if value == parent_id:
-            if hide_deleted_comments and id_map[key]['body'] in removed_content_identifiers and 't1_' + key not in parent_map.values():
-                pass
-            else:
-                child_comments.append(id_map[key])
+    for child_comment in child_map.get('t1_' + parent_comment['id'], []):
+        if hide_deleted_comments and child_comment['body'] in removed_content_identifiers and 't1_' + child_comment['id'] not in child_map:
+            pass
+        else:
+            child_comments.append(child_comment)
 
     # sort children by score
     # TODO: sort by score and # of child comments
-    if len(child_comments) > 0:
-        child_comments = sorted(child_comments, key=lambda k: (int(k['score']) if k['score'] != '' else 1), reverse=True)
-        for child_comment in child_comments:
-            child_comment['depth'] = depth
-            tree.append(child_comment)
-            tree = get_comment_tree_list(tree, depth + 1, child_comment, id_map, parent_map, hide_deleted_comments)
+    return sorted(child_comments, key=lambda k: (int(k['score']) if k['score'] != '' else 1), reverse=True)
+
+# depth first walk with an explicit stack, deep threads don't hit the recursion limit
+def get_comment_tree_list(depth, parent_comment, child_map, hide_deleted_comments):
+    tree = []
+    seen = set([parent_comment['id']])
+    stack = [(child_comment, depth) for child_comment in reversed(get_child_comments(parent_comment, child_map, hide_deleted_comments))]
+    while len(stack) > 0:
+        comment, comment_depth = stack.pop()
+        # broken data can contain reply cycles
+        if comment['id'] in seen:
+            continue
+        seen.add(comment['id'])
+        comment['depth'] = comment_depth
+        tree.append(comment)
+        for child_comment in reversed(get_child_comments(comment, child_map, hide_deleted_comments)):
+            stack.append((child_comment, comment_depth + 1))
     return tree
 
-def validate_link(link, min_score=0, min_comments=0):
-    if not link:
-        return False
-    elif not 'id' in link.keys():
-        return False
-    # apply multiple conditions as an OR, keep high score low comments and high comment low score links/posts
-    # TODO this should be configurable
-    if min_score > 0 and min_comments > 0:
-        if int(link['score']) < min_score and int(link['num_comments']) < min_comments:
-            return False
-    else:
-        if min_score > 0 and int(link['score']) < min_score:
-            return False
-        if min_comments > 0 and int(link['num_comments']) < min_comments:
-            return False
-
-    return True
-
+# with_comments is True, False or a function of the link row, see --shard
 def load_links(date, subreddit, with_comments=False):
     links = []
     if not date or not subreddit:
         return links
+    if sqlite_storage.db_exists(subreddit):
+        return sqlite_storage.load_links(date, subreddit, with_comments)
 
     date_path = date.strftime("%Y/%m/%d")
     daily_path = 'data/' + subreddit + '/' + date_path
@@ -726,7 +1785,7 @@ def load_links(date, subreddit, with_comments=False):
         with open(daily_links_path, 'r', encoding='utf-8') as links_file:
             reader = csv.DictReader(links_file)
             for link_row in reader:
-                if with_comments:
+                if with_comments is True or (with_comments and with_comments(link_row)):
                     comments = []
                     comments_file_path = daily_path + '/' + link_row['id'] + '.csv'
                     if os.path.isfile(comments_file_path):
@@ -738,33 +1797,58 @@ def load_links(date, subreddit, with_comments=False):
                 links.append(link_row)
     return links
 
+# dates with a links file, found by listing data/<sub>/YYYY/MM/DD instead of
+# checking every day since start_date
+def get_link_dates(subreddit):
+    dates = []
+    if sqlite_storage.db_exists(subreddit):
+        return [d for d in sqlite_storage.get_link_dates(subreddit) if start_date <= d <= end_date]
+    sub_path = 'data/' + subreddit
+    if not os.path.isdir(sub_path):
+        return dates
+    for year in sorted(os.listdir(sub_path)):
+        if not year.isdigit() or not os.path.isdir(sub_path + '/' + year):
+            continue
+        for month in sorted(os.listdir(sub_path + '/' + year)):
+            month_path = sub_path + '/' + year + '/' + month
+            if not month.isdigit() or not os.path.isdir(month_path):
+                continue
+            for day in sorted(os.listdir(month_path)):
+                if not day.isdigit() or not os.path.isfile(month_path + '/' + day + '/' + source_data_links):
+                    continue
+                try:
+                    d = date(int(year), int(month), int(day))
+                except ValueError:
+                    continue
+                if start_date <= d <= end_date:
+                    dates.append(d)
+    dates.sort()
+    return dates
+
 def get_subs():
     subs = []
     if not os.path.isdir('data'):
         print('ERROR: no data, run fetch_links.py first')
         return subs
+    # every subreddit, also with --sub, menus and signatures list them all
     for d in os.listdir('data'):
         if os.path.isdir('data' + '/' + d):
-            if d != args.sub and args.sub != "-": 
-                # Since we're not adding all subreddits to sub, we need
-                # to a list to append to so we can process the subreddits into the index file
-                #isubs.append(d.lower())
-                continue
             subs.append(d.lower())
     return subs
 
-def get_pager_html(page_num=1, pages=1):
+# url_base is the page file name without .html, following pages get separator and their number
+def get_pager_html(page_num=1, pages=1, url_base='index', separator='-'):
     html_pager = ''
 
     # previous
     css = ''
     if page_num == 1:
         css = 'disabled'
-    url = 'index'
+    url = url_base
     if page_num  - 1 > 1:
-        url += '-' + str(page_num - 1)
+        url += separator + str(page_num - 1)
     url += '.html'
-    html_pager += template_index_pager_link.replace('#URL#', url).replace('#TEXT#', '&lsaquo;').replace('#CSS_CLASS#', css)
+    html_pager += render_template(template_index_pager_link, {'#URL#': url, '#TEXT#': '&lsaquo;', '#CSS_CLASS#': css})
     
     # skip back
     css = ''
@@ -773,11 +1857,11 @@ def get_pager_html(page_num=1, pages=1):
         prev_skip = 1
     if page_num == 1:
         css = 'disabled'
-    url = 'index'
+    url = url_base
     if prev_skip > 1:
-        url += '-' + str(prev_skip)
+        url += separator + str(prev_skip)
     url += '.html'
-    html_pager += template_index_pager_link.replace('#URL#', url).replace('#TEXT#', '&lsaquo;&lsaquo;').replace('#CSS_CLASS#', css)
+    html_pager += render_template(template_index_pager_link, {'#URL#': url, '#TEXT#': '&lsaquo;&lsaquo;', '#CSS_CLASS#': css})
     
     # skip back far
     css = ''
@@ -786,11 +1870,11 @@ def get_pager_html(page_num=1, pages=1):
         prev_skip = 1
     if page_num == 1:
         css += ' disabled'
-    url = 'index'
+    url = url_base
     if prev_skip > 1:
-        url += '-' + str(prev_skip)
+        url += separator + str(prev_skip)
     url += '.html'
-    html_pager += template_index_pager_link.replace('#URL#', url).replace('#TEXT#', '&lsaquo;&lsaquo;&lsaquo;').replace('#CSS_CLASS#', css)
+    html_pager += render_template(template_index_pager_link, {'#URL#': url, '#TEXT#': '&lsaquo;&lsaquo;&lsaquo;', '#CSS_CLASS#': css})
 
     # n-1
     start = -2
@@ -801,19 +1885,19 @@ def get_pager_html(page_num=1, pages=1):
     for prev_page_num in range(start,0):
         if page_num + prev_page_num > 0:
             css = ''
-            url = 'index'
+            url = url_base
             if page_num + prev_page_num > 1:
-                url += '-' + str(page_num + prev_page_num)
+                url += separator + str(page_num + prev_page_num)
             url += '.html'
             if prev_page_num < -1:
                 css = 'd-none d-sm-block'
-            html_pager += template_index_pager_link.replace('#URL#', url).replace('#TEXT#', str(page_num + prev_page_num)).replace('#CSS_CLASS#', css)
+            html_pager += render_template(template_index_pager_link, {'#URL#': url, '#TEXT#': str(page_num + prev_page_num), '#CSS_CLASS#': css})
     # n
-    url = 'index'
+    url = url_base
     if page_num > 1:
-        url += '-' + str(page_num)
+        url += separator + str(page_num)
     url += '.html'
-    html_pager += template_index_pager_link.replace('#URL#', url).replace('#TEXT#', str(page_num)).replace('#CSS_CLASS#', 'active')
+    html_pager += render_template(template_index_pager_link, {'#URL#': url, '#TEXT#': str(page_num), '#CSS_CLASS#': 'active'})
     # n + 1
     css = ''
     end = 3
@@ -825,7 +1909,7 @@ def get_pager_html(page_num=1, pages=1):
         if page_num + next_page_num <= pages:
             if next_page_num > 1:
                 css = 'd-none d-sm-block'
-            html_pager += template_index_pager_link.replace('#URL#', 'index' + '-' + str(page_num + next_page_num) + '.html').replace('#TEXT#', str(page_num + next_page_num)).replace('#CSS_CLASS#', css)
+            html_pager += render_template(template_index_pager_link, {'#URL#': url_base + separator + str(page_num + next_page_num) + '.html', '#TEXT#': str(page_num + next_page_num), '#CSS_CLASS#': css})
 
     # skip forward far
     next_skip = page_num + pager_skip_long
@@ -834,11 +1918,11 @@ def get_pager_html(page_num=1, pages=1):
         css += ' disabled'
     if next_skip > pages:
         next_skip = pages
-    url = 'index'
+    url = url_base
     if next_skip > 1:
-        url += '-' + str(next_skip)
+        url += separator + str(next_skip)
     url += '.html'
-    html_pager += template_index_pager_link.replace('#URL#', url).replace('#TEXT#', '&rsaquo;&rsaquo;&rsaquo;').replace('#CSS_CLASS#', css)
+    html_pager += render_template(template_index_pager_link, {'#URL#': url, '#TEXT#': '&rsaquo;&rsaquo;&rsaquo;', '#CSS_CLASS#': css})
     
     # skip forward
     next_skip = page_num + pager_skip
@@ -847,11 +1931,11 @@ def get_pager_html(page_num=1, pages=1):
         css = 'disabled'
     if next_skip > pages:
         next_skip = pages
-    url = 'index'
+    url = url_base
     if next_skip > 1:
-        url += '-' + str(next_skip)
+        url += separator + str(next_skip)
     url += '.html'
-    html_pager += template_index_pager_link.replace('#URL#', url).replace('#TEXT#', '&rsaquo;&rsaquo;').replace('#CSS_CLASS#', css)
+    html_pager += render_template(template_index_pager_link, {'#URL#': url, '#TEXT#': '&rsaquo;&rsaquo;', '#CSS_CLASS#': css})
 
     # next
     css = ''
@@ -859,7 +1943,7 @@ def get_pager_html(page_num=1, pages=1):
     if page_num == pages:
       css = 'disabled'
       next_num = pages
-    html_pager += template_index_pager_link.replace('#URL#', 'index' + '-' + str(next_num) + '.html').replace('#TEXT#', '&rsaquo;').replace('#CSS_CLASS#', css)
+    html_pager += render_template(template_index_pager_link, {'#URL#': url_base + separator + str(next_num) + '.html', '#TEXT#': '&rsaquo;', '#CSS_CLASS#': css})
 
     return html_pager
 
@@ -868,21 +1952,40 @@ def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
-if __name__ == '__main__':
+def parse_args(argv=None):
     parser=argparse.ArgumentParser()
     parser.add_argument('--min-score', default=0, help='limit post rendering, default 0')
     parser.add_argument('--min-comments', default=0, help='limit post rendering, default 0')
     parser.add_argument('--hide-deleted-comments', action='store_true', help='exclude deleted and removed comments where possible')
     parser.add_argument('--noimages', help='Disable retrieving of images', action='store_true')
     parser.add_argument('--sub', default='-', help='Only write a specific subreddit', type=str)
+    parser.add_argument('--jobs', default=1, help='render link pages with this many processes, default 1')
+    parser.add_argument('--minify', action='store_true', help='remove template whitespace from pages')
+    parser.add_argument('--compress', action='store_true', help='write .gz and, with the brotli module installed, .br copies of pages for static servers')
+    parser.add_argument('--markdown-cache', action='store_true', help='keep rendered comments and selftexts in ' + markdown_cache_file + ' for later runs')
+    parser.add_argument('--pack', default=None, help='write the archive into this one sqlite file instead of r/, serve it with serve_pack.py')
+    parser.add_argument('--report', default=None, help='write the json run report here, default ' + report_file)
+    parser.add_argument('--profile', action='store_true', help='write cProfile stats of every stage to ' + profile_dir)
+    parser.add_argument('--shard', default=None, help='render part i of N, e.g. 2/8, on one of N machines, then run --merge')
+    parser.add_argument('--merge', action='store_true', help='write user pages and the index page from the --shard output in ' + shards_dir)
     #parser.add_argument('--index', default=None, help="Flag to write an index if --sub is specified")
-    args=parser.parse_args()
-
-    hide_deleted_comments = False
-    if args.hide_deleted_comments:
-        hide_deleted_comments = True
+    args=parser.parse_args(argv)
 
     args.min_score = int(args.min_score)
     args.min_comments = int(args.min_comments)
+    args.jobs = int(args.jobs)
+    if args.shard:
+        match = re.match(r'^(\d+)/(\d+)$', args.shard)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            parser.error('--shard takes i/N with 1 <= i <= N, e.g. 2/8')
+        args.shard = (int(match.group(1)), int(match.group(2)))
+    if args.shard and args.merge:
+        parser.error('--merge runs after all --shard runs, not with one')
+    return args
 
-    generate_html(args.min_score, args.min_comments, hide_deleted_comments)
+if __name__ == '__main__':
+    args = parse_args()
+    if args.merge:
+        merge_shards(args.jobs)
+    else:
+        generate_html(args.min_score, args.min_comments, args.hide_deleted_comments, args.jobs)